@@ -13,10 +13,16 @@ import matplotlib.pyplot as plt
 from sklearn.model_selection import train_test_split
 import json
 
-from utils import is_valid_file, setup_eager_checkpoints_and_restore
-from compression import snr
-from variational import VarMNIST, create_gaussian_prior, create_mixture_prior
+from utils import is_valid_file, setup_eager_checkpoints_and_restore, select_features, dataset_throughput, \
+    cached_arrays
+from compression import snr_histogram, snr_percentiles, pruning_schedule
+from variational import VarEstimator, VarMNIST, create_gaussian_prior, create_mixture_prior, \
+    average_categorical_logits
 from baseline import BaseMNIST
+from training import create_train_step
+from inference import InferenceModel, measure_latency, export_quantized, load_quantized, \
+    export_entropy_coded, load_entropy_coded, export_codebook, load_codebook, calibrate_density_threshold, \
+    DEFAULT_DENSITY_THRESHOLD
 
 tf.enable_eager_execution()
 
@@ -38,17 +44,96 @@ optimizers = {
     "rmsprop": tf.train.RMSPropOptimizer
 }
 
-def mnist_input_fn(data, labels, batch_size=128, shuffle_samples=5000):
+def mnist_input_fn(data,
+                   labels,
+                   batch_size=128,
+                   shuffle_samples=5000,
+                   input_indices=None,
+                   num_parallel_calls=4,
+                   prefetch_batches=2):
+    """
+    Takes images normalized all at once in numpy (see load_mnist), so the
+    pipeline only shuffles and batches. Any remaining work is done per batch,
+    in parallel, and batches are prefetched while the model trains.
+    """
     dataset = tf.data.Dataset.from_tensor_slices((data, labels))
-    dataset = dataset.shuffle(shuffle_samples)
-    dataset = dataset.map(mnist_parse_fn)
+
+    # No shuffling keeps the order of the examples, e.g. for evaluation
+    if shuffle_samples:
+        dataset = dataset.shuffle(shuffle_samples)
+
     dataset = dataset.batch(batch_size)
 
+    # Only keep the pixels a compressed model uses, one gather per batch
+    if input_indices is not None:
+        dataset = dataset.map(lambda data, labels: (select_features(data, input_indices), labels),
+                              num_parallel_calls=num_parallel_calls)
+
+    dataset = dataset.prefetch(prefetch_batches)
+
     return dataset
 
 
-def mnist_parse_fn(data, labels):#shuffle_samples=5000
-    return (tf.cast(tf.reshape(data, [-1]), tf.float32)/126., tf.cast(labels, tf.int64))
+def mnist_normalize(data, labels):
+    """
+    Flattens and scales the uint8 images of a whole split at once
+    """
+    data = data.reshape((len(data), -1)).astype(np.float32) / 126.
+
+    return data, labels.astype(np.int64)
+
+
+def load_mnist(validation_set_percentage, split_seed=None, cache_dir=None):
+    """
+    The normalized MNIST splits: train_data, train_labels, test_data,
+    test_labels and, if validation_set_percentage > 0, val_data and
+    val_labels. The normalized dataset is cached as memory-mapped arrays (see
+    utils.cached_arrays), so only the first run loads and normalizes it.
+
+    If split_seed is None, the train / validation split is random in every
+    run. Otherwise the split is reproducible, and it is cached as well.
+    """
+    def build():
+        ((train_data, train_labels),
+        (test_data, test_labels)) = tf.keras.datasets.mnist.load_data()
+
+        arrays = {}
+
+        if split_seed is not None and validation_set_percentage > 0:
+            train_data, val_data, train_labels, val_labels = split(train_data, train_labels)
+
+            arrays["val_data"], arrays["val_labels"] = mnist_normalize(val_data, val_labels)
+
+        arrays["train_data"], arrays["train_labels"] = mnist_normalize(train_data, train_labels)
+        arrays["test_data"], arrays["test_labels"] = mnist_normalize(test_data, test_labels)
+
+        return arrays
+
+    def split(data, labels):
+        return train_test_split(data,
+                                labels,
+                                test_size=validation_set_percentage,
+                                shuffle=True,
+                                stratify=labels,
+                                random_state=split_seed)
+
+    # Random splits are not part of the cache
+    cached_split = split_seed is not None and validation_set_percentage > 0
+
+    mnist = cached_arrays("mnist",
+                          params={"scale": 126.,
+                                  "validation_set_percentage": validation_set_percentage if cached_split else 0,
+                                  "split_seed": split_seed if cached_split else None},
+                          build_fn=build,
+                          cache_dir=cache_dir)
+
+    if split_seed is None and validation_set_percentage > 0:
+        mnist = dict(mnist)
+
+        mnist["train_data"], mnist["val_data"], mnist["train_labels"], mnist["val_labels"] = \
+            split(mnist["train_data"], mnist["train_labels"])
+
+    return mnist
 
 
 def run(args):
@@ -65,6 +150,11 @@ def run(args):
         "log_freq": 100,
         "checkpoint_name": "_ckpt",
         "validation_set_percentage": 0.1,
+        # Seed of the train / validation split, None for a new random split
+        # in every run. A seeded split is cached with the dataset.
+        "split_seed": None,
+        # Where the preprocessed splits are cached, None for the default
+        "dataset_cache_dir": None,
         "num_units": 800,
         "dropout": True,
         "prior_params": {
@@ -79,11 +169,38 @@ def run(args):
         },
         "prior": "mixture",
         "optimizer": "adam",
-        "beta": 1.
+        "beta": 1.,
+        # One of VarLinear.ESTIMATORS
+        "estimator": "weight",
+        # Number of weight samples in the forward pass and ELBO estimate
+        "num_samples": 1,
+        # Layers below this density use sparse matmuls for sparse inference. The
+        # default is a guess, None measures it with calibrate_density_threshold
+        "sparse_density_threshold": DEFAULT_DENSITY_THRESHOLD,
+        # Prune gradually during training, so that later epochs only sample the unpruned weights, e.g.
+        # {"initial_percentile": 0, "final_percentile": 98, "start_epoch": 1, "end_epoch": 20}
+        "pruning_schedule": None,
+        # "weights" prunes single weights, "neurons" whole hidden neurons
+        "pruning_mode": "weights",
+        # Precision of the exported posterior means, "float16", "quantized"
+        # (2 to 8 bits per weight), or "entropy" to entropy code them under the prior
+        "export_dtype": "quantized",
+        # Largest quantization step of the quantized and entropy coded exports, as
+        # a multiple of sigma
+        "export_tolerance": 1.,
+        # Codebook size per layer for --weight_sharing (15 packs the indices
+        # in 4 bits, since the pruned weights take another entry), and whether the
+        # clustering is weighted by the posterior precisions
+        "num_clusters": 16,
+        "weighted_clustering": True,
+        # Compile the train step with XLA
+        "jit_compile": False,
+        # Percentiles evaluated by --pruning_sweep
+        "sweep_percentiles": [0, 50, 80, 90, 95, 97, 98, 99, 99.5]
     }
 
     if args.config is not None:
-        config = json.load(args.config)
+        config.update(json.load(args.config))
 
     print(json.dumps(config, indent=4, sort_keys=True))
 
@@ -105,19 +222,18 @@ def run(args):
     # ==========================================================================
     # Loading in the dataset
     # ==========================================================================
-    ((train_data, train_labels),
-    (test_data, test_labels)) = tf.keras.datasets.mnist.load_data()
+    mnist = load_mnist(validation_set_percentage=config["validation_set_percentage"],
+                       split_seed=config["split_seed"],
+                       cache_dir=config["dataset_cache_dir"])
+
+    train_data, train_labels = mnist["train_data"], mnist["train_labels"]
+    test_data, test_labels = mnist["test_data"], mnist["test_labels"]
 
-    test_img_1 = test_data[0]
-    test_img_2 = test_data[5]
+    test_img_1 = test_data[0].reshape((28, 28))
+    test_img_2 = test_data[5].reshape((28, 28))
 
     if config["validation_set_percentage"] > 0:
-        train_data, val_data, train_labels, val_labels = train_test_split(
-            train_data,
-            train_labels,
-            test_size=config["validation_set_percentage"],
-            shuffle=True,
-            stratify=train_labels)
+        val_data, val_labels = mnist["val_data"], mnist["val_labels"]
 
         val_dataset = mnist_input_fn(val_data,
                                      val_labels,
@@ -129,6 +245,10 @@ def run(args):
                                    train_labels,
                                    batch_size=config["batch_size"])
 
+    if args.probe_input:
+        print("Input pipeline throughput: {:.0f} examples/sec".format(
+            dataset_throughput(train_dataset)))
+
 
     # ==========================================================================
     # Define the model
@@ -136,26 +256,40 @@ def run(args):
 
     model = models[args.model](units=config["num_units"],
                                prior=weight_prior,
-                               dropout=config["dropout"])
+                               dropout=config["dropout"],
+                               estimator=config["estimator"])
 
     # Connect the model computational graph by executing a forward-pass
     model(tf.zeros((1, 28, 28)))
 
+    # Stack all weight samples into a single forward pass
+    if isinstance(model, VarEstimator):
+        forward = lambda inputs: model(inputs, num_samples=config["num_samples"])
+    else:
+        forward = model
+
     optimizer = optimizers[config["optimizer"]](config["learning_rate"])
 
+    train_step = create_train_step(model=model,
+                                   optimizer=optimizer,
+                                   forward=forward,
+                                   jit_compile=config["jit_compile"])
+
     # ==========================================================================
     # Define Checkpoints
     # ==========================================================================
 
     global_step = tf.train.get_or_create_global_step()
 
-    trainable_vars = model.get_all_variables() + (global_step,)
+    # This includes non-trainable variables, e.g. the pruning masks
+    checkpoint_vars = model.get_all_variables(collection=tf.GraphKeys.GLOBAL_VARIABLES) + (global_step,)
     checkpoint_dir = os.path.join(args.model_dir, "checkpoints")
 
     checkpoint, ckpt_prefix = setup_eager_checkpoints_and_restore(
-        variables=trainable_vars,
+        variables=checkpoint_vars,
         checkpoint_dir=checkpoint_dir,
-        checkpoint_name=config["checkpoint_name"])
+        checkpoint_name=config["checkpoint_name"],
+        optional_variables=model.mask_variables if isinstance(model, VarEstimator) else ())
 
     # ==========================================================================
     # Define Tensorboard Summaries
@@ -187,22 +321,10 @@ def run(args):
                     # Increment global step
                     global_step.assign_add(1)
 
-                    # Record gradients of the forward pass
-                    with tf.GradientTape() as tape:
-
-                        logits = model(features)
-
-                        kl_coeff = config["beta"] / float(num_batches)
-
-                        kl_divergence = kl_coeff * model.kl_divergence
-                        neg_log_prob = model.negative_log_likelihood(logits, labels)
+                    kl_coeff = config["beta"] / float(num_batches)
 
-                        # negative ELBO
-                        loss =  kl_divergence + neg_log_prob
-
-                    # Backprop
-                    grads = tape.gradient(loss, model.get_all_variables())
-                    optimizer.apply_gradients(zip(grads, model.get_all_variables()))
+                    # SGD step on the negative ELBO
+                    loss, kl_divergence, neg_log_prob, logits = train_step(features, labels, kl_coeff)
 
                     # =================================
                     # Add summaries for tensorboard
@@ -210,7 +332,7 @@ def run(args):
                     with tfs_logger(config["log_freq"]):
                         tfs.scalar("Loss", loss)
 
-                        predictions = tf.argmax(input=logits,
+                        predictions = tf.argmax(input=average_categorical_logits(logits),
                                                 axis=1)
                         train_accuracy(labels=labels,
                                     predictions=predictions)
@@ -223,9 +345,9 @@ def run(args):
 
 
             if val_dataset is not None:
-                logits = model(val_data)
+                logits = forward(val_data)
 
-                val_predictions = tf.argmax(input=logits,
+                val_predictions = tf.argmax(input=average_categorical_logits(logits),
                                             axis=1)
 
                 val_accuracy(labels=val_labels,
@@ -236,6 +358,20 @@ def run(args):
 
                 tfs.scalar("Validation Accuracy", acc)
 
+            # Prune at the end of the epoch, so the next one trains the pruned model.
+            # Pruned parameters are no longer sampled or updated, but the
+            # matmuls keep their dense shapes.
+            if config["pruning_schedule"] is not None:
+                percentile = pruning_schedule(epoch, **config["pruning_schedule"])
+
+                pruning_threshold, = snr_percentiles(model.snrs(), [percentile])
+
+                print("Pruning {:.2f}% of model parameters, threshold is {:.2f}".format(
+                    percentile,
+                    pruning_threshold))
+
+                model.prune_below_snr(pruning_threshold, verbose=True)
+
             checkpoint.save(ckpt_prefix)
 
     else:
@@ -246,13 +382,27 @@ def run(args):
     # ==========================================================================
 
     model.is_training = False
-    # Silly hack to get the entire training set
-    for data, labels in mnist_input_fn(test_data, test_labels, batch_size=len(test_data)):
-        test_data = data
-        test_labels = labels
 
-    logits = model(test_data)
-    predictions = tf.argmax(input=logits,
+    test_data = tf.convert_to_tensor(test_data)
+    test_labels = tf.convert_to_tensor(test_labels)
+
+    if config["sparse_density_threshold"] is None:
+        # Measure the crossover on the shape of the first layer
+        input_size, output_size = model.layers[0].w_mu.shape.as_list()
+
+        threshold, measurements = calibrate_density_threshold(input_size,
+                                                              output_size,
+                                                              batch_size=int(test_data.shape[0]))
+
+        for density, dense_latency, sparse_latency in measurements:
+            print("Density {:.2f}: dense {:.6f}s, sparse {:.6f}s".format(density, dense_latency, sparse_latency))
+
+        print("Calibrated sparse density threshold: {:.2f}".format(threshold))
+
+        config["sparse_density_threshold"] = threshold
+
+    logits = forward(test_data)
+    predictions = tf.argmax(input=average_categorical_logits(logits),
                             axis=1)
     test_accuracy(labels=test_labels,
                   predictions=predictions)
@@ -267,16 +417,23 @@ def run(args):
     if args.prune_weights:
         print("Pruning {}% of model parameters!".format(config["pruning_percentile"]))
 
-        binwidth = 0.5
-        snr_vector = snr(model.mu_vector.numpy(), model.sigma_vector.numpy())
+        # In the neuron mode, the percentile is of the hidden neurons
+        if config["pruning_mode"] == "neurons":
+            snrs, prune_below_snr = model.neuron_snrs(), model.prune_neurons_below_snr
+        else:
+            snrs, prune_below_snr = model.snrs(), model.prune_below_snr
+
+        # Compute the SNRs of each layer only once
+        snrs = list(snrs)
+
+        # Parameters that were pruned during training are left out of the histogram
+        snr_counts, snr_edges = snr_histogram(snrs, bin_width=0.5)
 
-        pruning_threshold = np.percentile(snr_vector,
-                                        q=config["pruning_percentile"],
-                                        interpolation='lower')
+        pruning_threshold, = snr_percentiles(snrs, [config["pruning_percentile"]])
 
         print("Pruning threshold is {:.2f}".format(pruning_threshold))
 
-        model.prune_below_snr(pruning_threshold, verbose=True)
+        prune_below_snr(pruning_threshold, verbose=True)
 
         # logits = model(test_data)
         # predictions = tf.argmax(input=logits,
@@ -284,11 +441,38 @@ def run(args):
 
 
         # Compress
-        reduced_model = model.compress()
-
-        reduced_model(tf.zeros((1, 28, 28)))
-        reduced_model.assign_params()
-        logits = reduced_model(test_data)
+        reduced_model = model.compress(verbose=True)
+
+        # The reduced model only takes the pixels it uses, which are selected
+        # in the input pipeline. It is not trained any further, so only the
+        # evaluation sets need to be reduced.
+        reduced_test_dataset = mnist_input_fn(mnist["test_data"],
+                                              mnist["test_labels"],
+                                              batch_size=len(mnist["test_data"]),
+                                              shuffle_samples=None,
+                                              input_indices=reduced_model.input_indices)
+
+        for reduced_test_data, _ in reduced_test_dataset:
+            pass
+
+        if val_dataset is not None:
+            reduced_val_dataset = mnist_input_fn(mnist["val_data"],
+                                                 mnist["val_labels"],
+                                                 batch_size=len(mnist["val_data"]),
+                                                 shuffle_samples=None,
+                                                 input_indices=reduced_model.input_indices)
+
+            for reduced_val_data, reduced_val_labels in reduced_val_dataset:
+                reduced_val_predictions = tf.argmax(input=reduced_model(reduced_val_data),
+                                                    axis=1)
+
+                reduced_val_accuracy = tfe.metrics.Accuracy()
+                reduced_val_accuracy(labels=reduced_val_labels,
+                                     predictions=reduced_val_predictions)
+
+                print("Reduced model validation accuracy: {:.2f}%".format(100 * reduced_val_accuracy.result()))
+
+        logits = reduced_model(reduced_test_data)
         predictions = tf.argmax(input=logits,
                                 axis=1)
         test_accuracy(labels=test_labels,
@@ -299,19 +483,115 @@ def run(args):
             config["pruning_percentile"],
             acc))
 
-        model_size = 2 * model.mu_vector.numpy().shape[0]
-        reduced_model_size = 2 * reduced_model.mu_vector.numpy().shape[0]
+        model_size = 2 * model.num_params
+        reduced_model_size = 2 * reduced_model.num_params
 
         print("Model parameter count: {}, Reduced model parameter count: {}, compression: {:.2f}%".format(model_size, reduced_model_size, float(reduced_model_size) / model_size * 100) )
 
-        plt.hist(snr_vector, bins=np.arange(min(snr_vector), max(snr_vector) + binwidth, binwidth))
+        if args.sparse_inference:
+            # Sparse or dense format is picked per layer based on its density
+            sparse_model = InferenceModel.from_estimator(model,
+                                                         density_threshold=config["sparse_density_threshold"])
+            dense_model = InferenceModel.from_estimator(model, density_threshold=0.)
+
+            print(sparse_model.summary())
+
+            predictions = tf.argmax(input=sparse_model(test_data),
+                                    axis=1)
+            sparse_accuracy = tfe.metrics.Accuracy()
+            sparse_accuracy(labels=test_labels,
+                            predictions=predictions)
+
+            print("Sparse inference accuracy (posterior means): {:.2f}%".format(
+                100 * sparse_accuracy.result()))
+
+            print("Test set latency, dense: {:.2f}ms, sparse: {:.2f}ms".format(
+                1000 * measure_latency(dense_model, test_data),
+                1000 * measure_latency(sparse_model, test_data)))
+
+        if args.export_path is not None and config["export_dtype"] == "entropy":
+            code_bits_per_weight, bits_per_weight, bits_per_unpruned_weight, num_outliers = \
+                export_entropy_coded(reduced_model,
+                                     args.export_path,
+                                     tolerance=config["export_tolerance"])
+
+            print("Exported the reduced model to {} ({} bytes, {:.2f} bits per weight, "
+                  "{:.2f} bits per unpruned weight, of which the code is {:.2f} bits per weight, "
+                  "{} weights stored as float32 to meet the tolerance)".format(
+                      args.export_path,
+                      os.path.getsize(args.export_path),
+                      bits_per_weight,
+                      bits_per_unpruned_weight,
+                      code_bits_per_weight,
+                      num_outliers))
+
+            exported_model = load_entropy_coded(args.export_path,
+                                                density_threshold=config["sparse_density_threshold"])
+
+        elif args.export_path is not None:
+            bits_per_weight, num_outliers = export_quantized(reduced_model,
+                                                             args.export_path,
+                                                             dtype=config["export_dtype"],
+                                                             tolerance=config["export_tolerance"])
+
+            print("Exported the reduced model to {} ({} bytes, {:.2f} bits per weight, "
+                  "{} weights stored as float32 to meet the tolerance)".format(
+                      args.export_path,
+                      os.path.getsize(args.export_path),
+                      bits_per_weight,
+                      num_outliers))
+
+            exported_model = load_quantized(args.export_path,
+                                            density_threshold=config["sparse_density_threshold"])
+
+        if args.export_path is not None:
+            predictions = tf.argmax(input=exported_model(test_data),
+                                    axis=1)
+            exported_accuracy = tfe.metrics.Accuracy()
+            exported_accuracy(labels=test_labels,
+                              predictions=predictions)
+
+            print("Exported model accuracy (posterior means): {:.2f}%".format(
+                100 * exported_accuracy.result()))
+
+        if args.weight_sharing and args.export_path is not None:
+            codebook_path = os.path.splitext(args.export_path)[0] + "_codebook.npz"
+
+            bits_per_weight = export_codebook(reduced_model,
+                                              codebook_path,
+                                              num_clusters=config["num_clusters"],
+                                              weighted=config["weighted_clustering"])
+
+            print("Exported the weight shared model to {} ({} bytes, {:.2f} bits per weight)".format(
+                codebook_path,
+                os.path.getsize(codebook_path),
+                bits_per_weight))
+
+            codebook_model = load_codebook(codebook_path)
+
+        elif args.weight_sharing:
+            codebook_model = InferenceModel.from_estimator(reduced_model,
+                                                           num_clusters=config["num_clusters"],
+                                                           weighted_clustering=config["weighted_clustering"])
+
+            predictions = tf.argmax(input=codebook_model(reduced_test_data),
+                                    axis=1)
+            codebook_accuracy = tfe.metrics.Accuracy()
+            codebook_accuracy(labels=test_labels,
+                              predictions=predictions)
+
+            print("Weight sharing with {} clusters per layer, accuracy (posterior means): {:.2f}%".format(
+                config["num_clusters"],
+                100 * codebook_accuracy.result()))
+
+        plt.hist(snr_edges[:-1], bins=snr_edges, weights=snr_counts)
         plt.axvline(x=pruning_threshold, color='tab:red')
         plt.xlabel('Signal-To-Noise Ratio (dB)')
         plt.ylabel('Density')
         plt.title('Histogram of the Signal-To-Noise ratio over all weights in the network')
         plt.show()
 
-        input_mask = reduced_model.get_unused_input_mask()
+        input_mask = reduced_model.get_unused_input_mask((28, 28))
         plt.imshow(input_mask)
         plt.axis('off')
         plt.show()
@@ -323,6 +603,44 @@ def run(args):
         plt.imshow(input_mask * test_img_2)
         plt.show()
 
+    # ==========================================================================
+    # Pruning sweep
+    # ==========================================================================
+
+    if args.pruning_sweep:
+        percentiles = sorted(config["sweep_percentiles"])
+
+        # The thresholds are increasing, and pruned weights stay pruned, so the
+        # masks can be tightened incrementally on the same model
+        thresholds = snr_percentiles(model.snrs(), percentiles)
+
+        model_size = model.num_params
+
+        print("{:>12} {:>12} {:>12} {:>16} {:>14}".format(
+            "Percentile", "Threshold", "Accuracy", "Surviving params", "Latency (ms)"))
+
+        for percentile, pruning_threshold in zip(percentiles, thresholds):
+            model.prune_below_snr(pruning_threshold)
+
+            logits = forward(test_data)
+            predictions = tf.argmax(input=average_categorical_logits(logits),
+                                    axis=1)
+
+            sweep_accuracy = tfe.metrics.Accuracy()
+            sweep_accuracy(labels=test_labels,
+                           predictions=predictions)
+
+            inference_model = InferenceModel.from_estimator(model,
+                                                            density_threshold=config["sparse_density_threshold"])
+
+            print("{:>12.2f} {:>12.2f} {:>11.2f}% {:>16} {:>14.2f}".format(
+                percentile,
+                pruning_threshold,
+                100 * sweep_accuracy.result(),
+                "{} ({:.2f}%)".format(model.num_unpruned_params,
+                                      100. * model.num_unpruned_params / model_size),
+                1000 * measure_latency(inference_model, test_data)))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Bayes By Backprop models')
@@ -337,6 +655,16 @@ if __name__ == "__main__":
                     help='Path to the config JSON file.')
     parser.add_argument('--prune_weights', action="store_true", dest="prune_weights", default=False,
                     help='Should we do weight pruning during evaluation.')
+    parser.add_argument('--sparse_inference', action="store_true", dest="sparse_inference", default=False,
+                    help='Evaluate the pruned model with sparse matmuls.')
+    parser.add_argument('--export_path', type=str, default=None,
+                    help='Export the quantized pruned model to this .npz file.')
+    parser.add_argument('--weight_sharing', action="store_true", dest="weight_sharing", default=False,
+                    help='Evaluate the pruned model with codebook weight sharing, and export it next to --export_path.')
+    parser.add_argument('--probe_input', action="store_true", dest="probe_input", default=False,
+                    help='Measure the throughput of the training input pipeline alone.')
+    parser.add_argument('--pruning_sweep', action="store_true", dest="pruning_sweep", default=False,
+                    help='Evaluate the model pruned at each of the sweep percentiles in a single pass.')
     args = parser.parse_args()
 
     run(args)
@@ -1,5 +1,7 @@
 import numpy as np
-import tensorflow as tf
+from scipy.special import ndtr
+
+from collections import namedtuple
 
 def snr(mus, sigmas):
     if mus.shape != sigmas.shape:
@@ -10,111 +12,739 @@ def snr(mus, sigmas):
 
     return 10. * (np.log10(np.abs(mus)) - np.log10(sigmas))
 
-def eliminate_dead_neurons(w_mus, w_sigmas, b_mus, b_sigmas, activations):
+def _bin_indices(values, edges):
     """
-    weights - list of weights in the neural network
-    biases - list of biases
-    activation - list of activation functions for each layer
+    Histogram bin of every value, bins are [e_i, e_i+1) except the last one,
+    which also contains its right edge (same as np.histogram)
     """
+    indices = np.searchsorted(edges, values, side='right') - 1
 
-    old_num_zeros = 0
+    return np.minimum(indices, len(edges) - 2)
+
+def _snr_range(layer_snrs):
+    """
+    Total number of SNRs, number of pruned ones (-inf) and the range of the rest
+    """
+    num_snrs = 0
+    num_pruned = 0
 
-    for i in range(len(w_mus)):
-        old_num_zeros += np.sum((w_mus[i] == 0).astype(np.float32) * (w_sigmas[i] == 0).astype(np.float32))
-        old_num_zeros += np.sum((b_mus[i] == 0).astype(np.float32) * (b_sigmas[i] == 0).astype(np.float32))
+    low, high = np.inf, -np.inf
 
-    num_layers = len(w_mus)
+    for snrs in layer_snrs:
+        finite = snrs[np.isfinite(snrs)]
 
-    backward_non_zeros_removed = 0
+        num_snrs += snrs.size
+        num_pruned += snrs.size - finite.size
 
-    # Backward pass
-    for i in range(num_layers - 1, -1, -1):
+        if finite.size > 0:
+            low = min(low, np.min(finite))
+            high = max(high, np.max(finite))
 
-        w_mu = w_mus[i]
-        w_sigma = w_sigmas[i]
+    return num_snrs, num_pruned, low, high
 
-        num_rows = w_mu.shape[0]
+def snr_histogram(layer_snrs, bin_width=None, num_bins=1024):
+    """
+    Histogram of the unpruned SNRs over all layers, merged from per-layer
+    histograms.
 
-        # Check for a zero-column
-        # Only weights set by pruning will have 0 variance
-        keep_indices = [j for j in range(num_rows) if not np.all(w_sigma[j, :] == 0)]
-        drop_indices = [j for j in range(num_rows) if np.all(w_sigma[j, :] == 0)]
+    layer_snrs - list of SNR arrays (e.g. one per layer), where pruned
+                 parameters have SNR -inf
 
-        #print(len(keep_indices))
+    Returns the counts and the bin edges.
+    """
+    layer_snrs = list(layer_snrs)
 
-        # Remove rows on current layer
-        w_mus[i] = w_mu[keep_indices, :]
-        w_sigmas[i] = w_sigma[keep_indices, :]
+    _, _, low, high = _snr_range(layer_snrs)
 
-        # Remove columns on previous layer and unused biases
-        if i > 0:
-            backward_non_zeros_removed += \
-                np.sum((w_mus[i - 1][:, drop_indices] != 0).astype(np.float32) + (w_sigmas[i - 1][:, drop_indices] != 0).astype(np.float32))
-            backward_non_zeros_removed += \
-                np.sum((b_mus[i - 1][drop_indices] != 0).astype(np.float32) + (b_sigmas[i - 1][drop_indices] != 0).astype(np.float32))
+    if bin_width is not None:
+        edges = np.arange(low, high + bin_width, bin_width)
+    else:
+        edges = np.linspace(low, max(high, low + 1e-6), num_bins + 1)
 
-            w_mus[i - 1] = w_mus[i - 1][:, keep_indices]
-            w_sigmas[i - 1] = w_sigmas[i - 1][:, keep_indices]
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
 
-            b_mus[i - 1] = b_mus[i - 1][keep_indices]
-            b_sigmas[i - 1] = b_sigmas[i - 1][keep_indices]
-        else:
-            kept_input_indices = keep_indices
+    for snrs in layer_snrs:
+        finite = snrs[np.isfinite(snrs)]
+        counts += np.bincount(_bin_indices(finite, edges), minlength=len(counts))
+
+    return counts, edges
+
+def snr_percentiles(layer_snrs, qs, num_bins=1024):
+    """
+    Percentiles (q in [0, 100], with 'lower' interpolation) of the SNRs of all
+    layers, without concatenating them. Pruned parameters count as the
+    lowest SNRs. Since they are used as thresholds for pruning everything
+    that is not above them, q <= 0 gives -inf, which prunes nothing.
+
+    The merged histogram of the SNRs locates the bin of every requested
+    percentile, and only the values in those bins are gathered and sorted
+    to get the exact result.
+
+    layer_snrs - list of SNR arrays (e.g. one per layer), where pruned
+                 parameters have SNR -inf
+    qs - list of percentiles
+
+    Returns the percentiles as an array in the order of qs.
+    """
+    # Generators are only evaluated once, we pass over the SNRs three times
+    layer_snrs = list(layer_snrs)
 
-        #print("Shapes: {}, {}".format(w_mus[i].shape, b_mus[i].shape))
+    num_snrs, num_pruned, _, _ = _snr_range(layer_snrs)
 
-    print("Backwards pass removed {} non-zero elements.".format(backward_non_zeros_removed))
-    #print(np.sum(w_mus[2] != 0., axis=1))
+    counts, edges = snr_histogram(layer_snrs, num_bins=num_bins)
+    cumulative_counts = np.cumsum(counts)
 
-    forward_non_zeros_removed = 0
-    # Forward pass
-    for i in range(num_layers):
+    # Rank of every percentile in the sorted SNRs and among the unpruned ones
+    ranks = np.floor(np.asarray(qs, dtype=np.float64) / 100. * (num_snrs - 1)).astype(np.int64)
+    finite_ranks = ranks - num_pruned
 
-        w_mu = w_mus[i]
-        w_sigma = w_sigmas[i]
+    percentiles = np.full(len(ranks), -np.inf)
 
-        num_cols = w_mu.shape[1]
+    # The 0th percentile is the smallest SNR, pruning up to it would prune it
+    is_finite = (finite_ranks >= 0) & (np.asarray(qs) > 0)
 
-        # Check for a zero-row
-        # Only weights set by pruning will have 0 variance
-        keep_indices = [j for j in range(num_cols) if not np.all(w_sigma[:, j] == 0)]
-        drop_indices = [j for j in range(num_cols) if np.all(w_sigma[:, j] == 0)]
+    if not np.any(is_finite):
+        return percentiles
 
-        #print(len(keep_indices))
+    bins = np.searchsorted(cumulative_counts, finite_ranks[is_finite], side='right')
+    target_bins = np.unique(bins)
 
-        # Remove columns on current layer
-        w_mus[i] = w_mu[:, keep_indices]
-        w_sigmas[i] = w_sigma[:, keep_indices]
+    # Collect the SNRs in the bins we need
+    bin_values = {b: [] for b in target_bins}
 
-        # Remove rows on next layer and absorb dead neurons into biases
-        if i < num_layers - 1:
+    for snrs in layer_snrs:
+        finite = snrs[np.isfinite(snrs)]
+        indices = _bin_indices(finite, edges)
 
-            forward_non_zeros_removed += \
-                np.sum((w_mus[i + 1][drop_indices, :] != 0).astype(np.float32) + (w_sigmas[i + 1][drop_indices, :] != 0).astype(np.float32))
-            forward_non_zeros_removed += \
-                np.sum((b_mus[i][drop_indices] != 0).astype(np.float32) + (b_sigmas[i][drop_indices] != 0).astype(np.float32))
+        in_targets = np.isin(indices, target_bins)
 
+        for b in target_bins:
+            bin_values[b].append(finite[in_targets & (indices == b)])
 
+    bin_values = {b: np.sort(np.concatenate(values)) for b, values in bin_values.items()}
 
-            w_mus[i + 1] = w_mus[i + 1][keep_indices, :]
-            w_sigmas[i + 1] = w_sigmas[i + 1][keep_indices, :]
+    # Rank within the bin
+    offsets = np.concatenate([[0], cumulative_counts])[bins]
 
-            b_mus[i] = b_mus[i][keep_indices]
-            b_sigmas[i] = b_sigmas[i][keep_indices]
+    percentiles[is_finite] = [bin_values[b][r - offset]
+                              for b, r, offset in zip(bins, finite_ranks[is_finite], offsets)]
 
-        print("Shapes: {}, {}".format(w_mus[i].shape, b_mus[i].shape))
+    return percentiles
 
-    print("Forward pass removed {} non-zero elements.".format(forward_non_zeros_removed))
+def neuron_snr(w_mu_in, w_sigma_in, w_mu_out, w_sigma_out):
+    """
+    SNR (in dB) of the hidden neurons between two layers, aggregated over
+    their incoming weights (columns of the first layer) and outgoing weights
+    (rows of the second one): the total power of the means over the total
+    variance. Neurons with only pruned weights have SNR -inf.
+    """
+    signal = np.sum(np.square(w_mu_in), axis=0) + np.sum(np.square(w_mu_out), axis=1)
+    noise = np.sum(np.square(w_sigma_in), axis=0) + np.sum(np.square(w_sigma_out), axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        snrs = 10. * (np.log10(signal) - np.log10(noise))
+
+    snrs[np.isnan(snrs)] = -np.inf
+
+    return snrs
+
+def pruning_schedule(epoch, initial_percentile, final_percentile, start_epoch, end_epoch):
+    """
+    Cubic pruning schedule from Zhu & Gupta (2017): the pruning percentile
+    rises quickly after start_epoch, and levels off as it approaches
+    final_percentile at end_epoch.
+
+    VarLinear only samples the unpruned weights, but the layers keep their
+    dense shapes for the matmuls.
+    """
+    if epoch <= start_epoch:
+        return initial_percentile
+
+    if epoch >= end_epoch:
+        return final_percentile
+
+    progress = (epoch - start_epoch) / float(end_epoch - start_epoch)
+
+    return final_percentile + (initial_percentile - final_percentile) * (1. - progress)**3
+
+class EliminationReport(namedtuple("EliminationReport", ["num_iterations",
+                                                         "backward_removed",
+                                                         "forward_removed",
+                                                         "num_absorbed",
+                                                         "layer_shapes",
+                                                         "old_num_zeros",
+                                                         "new_num_zeros"])):
+    """
+    Summary of eliminate_dead_neurons:
+     - num_iterations: number of sweeps until the fixed point was reached
+     - backward_removed: non-zero elements removed with neurons that have
+       no surviving outgoing weights
+     - forward_removed: non-zero elements removed with neurons that have no
+       surviving incoming weights
+     - num_absorbed: number of neurons absorbed into the next layer's biases
+     - layer_shapes: shapes of the remaining weight matrices
+     - old_num_zeros, new_num_zeros: number of pruned parameters before and after
+    """
+
+    def __str__(self):
+        return "\n".join([
+            "Eliminating dead neurons took {} sweeps.".format(self.num_iterations),
+            "Backwards elimination removed {} non-zero elements.".format(self.backward_removed),
+            "Forwards elimination removed {} non-zero elements, absorbed {} neurons into biases.".format(
+                self.forward_removed, self.num_absorbed),
+            "Shapes: {}".format(self.layer_shapes),
+            "Old # 0: {}, New # 0: {}, Ratio: {:.2f}%".format(
+                self.old_num_zeros,
+                self.new_num_zeros,
+                100 * float(self.new_num_zeros) / max(self.old_num_zeros, 1))])
+
+
+def count_pruned(w_mus, w_sigmas, b_mus, b_sigmas):
+    """
+    Number of parameters that were set to 0 by pruning
+    """
     num_zeros = 0
 
-    for i in range(len(w_mus)):
-        num_zeros += np.sum((w_mus[i] == 0).astype(np.float32) * (w_sigmas[i] == 0).astype(np.float32))
-        num_zeros += np.sum((b_mus[i] == 0).astype(np.float32) * (b_sigmas[i] == 0).astype(np.float32))
+    for w_mu, w_sigma, b_mu, b_sigma in zip(w_mus, w_sigmas, b_mus, b_sigmas):
+        num_zeros += np.count_nonzero((w_mu == 0) & (w_sigma == 0))
+        num_zeros += np.count_nonzero((b_mu == 0) & (b_sigma == 0))
+
+    return num_zeros
+
+
+def eliminate_dead_neurons(w_mus, w_sigmas, b_mus, b_sigmas, activations):
+    """
+    Removes every input feature and hidden neuron that cannot influence the
+    output, repeating until no more can be removed (removing a neuron can
+    kill others). A neuron is dead if
+     - all of its outgoing weights are pruned, or
+     - all of its incoming weights are pruned. Its output is then the constant
+       activation(b_mu), which is absorbed into the next layer's bias means.
+    Only weights set by pruning will have 0 variance. Output units are kept.
+
+    w_mus, w_sigmas - lists of weight parameters of the layers
+    b_mus, b_sigmas - lists of bias parameters
+    activations - list of activation functions for each layer
+
+    Returns the kept input indices, the reduced parameter lists and an
+    EliminationReport.
+    """
+
+    w_mus, w_sigmas = list(w_mus), list(w_sigmas)
+    b_mus, b_sigmas = list(b_mus), list(b_sigmas)
+
+    num_layers = len(w_mus)
+
+    old_num_zeros = count_pruned(w_mus, w_sigmas, b_mus, b_sigmas)
+
+    input_indices = np.arange(w_mus[0].shape[0])
+
+    num_iterations = 0
+    backward_removed = 0
+    forward_removed = 0
+    num_absorbed = 0
+
+    changed = True
+
+    while changed:
+        changed = False
+        num_iterations += 1
+
+        # Input features without any surviving outgoing weight
+        keep = np.any(w_sigmas[0] != 0, axis=1)
+
+        if not np.all(keep):
+            changed = True
+
+            input_indices = input_indices[keep]
+
+            w_mus[0] = w_mus[0][keep, :]
+            w_sigmas[0] = w_sigmas[0][keep, :]
+
+        # Hidden neurons, i.e. outputs of layer i and inputs of layer i + 1
+        for i in range(num_layers - 1):
+
+            backward_dead = ~np.any(w_sigmas[i + 1] != 0, axis=1)
+            forward_dead = ~np.any(w_sigmas[i] != 0, axis=0) & ~backward_dead
+
+            dead = backward_dead | forward_dead
+
+            if not np.any(dead):
+                continue
+
+            changed = True
+
+            # Everything attached to these neurons goes
+            backward_removed += \
+                np.count_nonzero(w_mus[i][:, backward_dead]) + np.count_nonzero(w_sigmas[i][:, backward_dead]) + \
+                np.count_nonzero(b_mus[i][backward_dead]) + np.count_nonzero(b_sigmas[i][backward_dead])
+
+            forward_removed += \
+                np.count_nonzero(w_mus[i + 1][forward_dead, :]) + np.count_nonzero(w_sigmas[i + 1][forward_dead, :]) + \
+                np.count_nonzero(b_mus[i][forward_dead]) + np.count_nonzero(b_sigmas[i][forward_dead])
+
+            # Absorb the constant outputs into the biases of the next layer
+            if np.any(forward_dead):
+                num_absorbed += np.count_nonzero(forward_dead)
+
+                constant_outputs = np.asarray(activations[i](b_mus[i][forward_dead]))
+                b_mus[i + 1] = b_mus[i + 1] + np.dot(constant_outputs, w_mus[i + 1][forward_dead, :])
+
+            keep = ~dead
+
+            # Remove columns on current layer and rows on the next one
+            w_mus[i] = w_mus[i][:, keep]
+            w_sigmas[i] = w_sigmas[i][:, keep]
+
+            b_mus[i] = b_mus[i][keep]
+            b_sigmas[i] = b_sigmas[i][keep]
+
+            w_mus[i + 1] = w_mus[i + 1][keep, :]
+            w_sigmas[i + 1] = w_sigmas[i + 1][keep, :]
+
+    report = EliminationReport(num_iterations=num_iterations,
+                               backward_removed=int(backward_removed),
+                               forward_removed=int(forward_removed),
+                               num_absorbed=int(num_absorbed),
+                               layer_shapes=[w_mu.shape for w_mu in w_mus],
+                               old_num_zeros=int(old_num_zeros),
+                               new_num_zeros=int(count_pruned(w_mus, w_sigmas, b_mus, b_sigmas)))
+
+    return list(input_indices), w_mus, w_sigmas, b_mus, b_sigmas, report
+
+
+def pack_bits(values, bits):
+    """
+    Packs unsigned integers below 2^bits (bits in 1, 2, 4, 8) into a uint8
+    array, 8 / bits values per byte
+    """
+    values = np.asarray(values, dtype=np.uint8).reshape(-1)
+    per_byte = 8 // bits
+
+    padded = np.zeros(-(-len(values) // per_byte) * per_byte, dtype=np.uint8)
+    padded[:len(values)] = values
+
+    shifts = np.arange(per_byte, dtype=np.uint8) * bits
+
+    return np.bitwise_or.reduce(padded.reshape((-1, per_byte)) << shifts, axis=1).astype(np.uint8)
+
+
+def unpack_bits(packed, bits, num_values):
+    """
+    Inverse of pack_bits
+    """
+    per_byte = 8 // bits
+
+    shifts = np.arange(per_byte, dtype=np.uint8) * bits
+
+    values = (packed[:, None] >> shifts) & np.uint8(2**bits - 1)
+
+    return values.reshape(-1)[:num_values]
+
+
+# Bits per weight of the precision classes, class 0 is for pruned weights
+QUANTIZATION_BITS = (0, 2, 4, 8)
+
+
+def quantize_weights(w_mu, w_sigma, tolerance=1.):
+    """
+    Quantizes the weight means with a precision set by the posterior: every
+    weight gets the fewest bits (out of QUANTIZATION_BITS) whose quantization
+    step is at most tolerance * sigma, so weights with large sigma (low SNR)
+    are stored coarsely. All classes share one per-layer scale (the largest
+    absolute mean): a b bit weight is round(mu / scale * (2^(b-1) - 1)).
+
+    Weights for which even the highest precision violates the tolerance are
+    additionally stored losslessly as float32 outliers, along with their
+    indices.
+
+    Returns a dict of arrays: the scale, the precision class of every weight
+    packed in 2 bits, the packed values of each class and the outliers.
+    """
+    w_mu = np.asarray(w_mu, dtype=np.float64).reshape(-1)
+    w_sigma = np.asarray(w_sigma, dtype=np.float64).reshape(-1)
+
+    unpruned = w_sigma > 0
+    scale = np.max(np.abs(w_mu[unpruned])) if np.any(unpruned) else 1.
+
+    # Highest precision by default
+    classes = np.where(unpruned, len(QUANTIZATION_BITS) - 1, 0).astype(np.uint8)
+
+    # Go from the highest to the lowest precision, so the last assignment is the coarsest
+    for c in range(len(QUANTIZATION_BITS) - 2, 0, -1):
+        step = scale / (2**(QUANTIZATION_BITS[c] - 1) - 1)
+        classes[unpruned & (step <= tolerance * w_sigma)] = c
+
+    # The highest precision is not enough for these
+    step = scale / (2**(QUANTIZATION_BITS[-1] - 1) - 1)
+    outliers = np.flatnonzero(unpruned & (step > tolerance * w_sigma))
+
+    quantized = {"scale": np.array(scale),
+                 "classes": pack_bits(classes, 2),
+                 "outlier_indices": outliers.astype(np.int32),
+                 "outlier_values": w_mu[outliers].astype(np.float32)}
+
+    for c, bits in enumerate(QUANTIZATION_BITS):
+        if c == 0:
+            continue
+
+        levels = 2**(bits - 1) - 1
+
+        values = np.round(w_mu[classes == c] / scale * levels).astype(np.int64)
+
+        # Store with an offset, so the values are unsigned
+        quantized["values_{}".format(bits)] = pack_bits(values + levels, bits)
+
+    return quantized
+
+
+def dequantize_weights(quantized, shape):
+    """
+    Inverse of quantize_weights, up to the quantization error
+    """
+    num_weights = int(np.prod(shape))
+
+    classes = unpack_bits(quantized["classes"], 2, num_weights)
+    scale = float(quantized["scale"])
+
+    w_mu = np.zeros(num_weights, dtype=np.float32)
+
+    for c, bits in enumerate(QUANTIZATION_BITS):
+        if c == 0:
+            continue
+
+        levels = 2**(bits - 1) - 1
+        in_class = classes == c
+
+        values = unpack_bits(quantized["values_{}".format(bits)], bits, np.count_nonzero(in_class))
+
+        w_mu[in_class] = (values.astype(np.float32) - levels) / levels * scale
+
+    w_mu[quantized["outlier_indices"]] = quantized["outlier_values"]
+
+    return w_mu.reshape(shape)
+
+
+def kmeans_codebook(w_mu, w_sigma, num_clusters=16, weighted=True, num_iterations=50):
+    """
+    Weight sharing: clusters the unpruned weight means of a layer into
+    num_clusters values with 1D k-means. If weighted, every weight counts with
+    its precision 1 / sigma^2, so the confident weights move less.
+
+    The first entry of the codebook is 0 for the pruned weights, so there are
+    at most 255 clusters.
+
+    Returns the codebook and the codebook index of every weight (uint8, with
+    the shape of w_mu).
+    """
+    if num_clusters > 255:
+        raise ValueError("At most 255 clusters are supported, not {}".format(num_clusters))
+
+    unpruned = w_sigma > 0
+
+    # Every weight of the layer was pruned
+    if not np.any(unpruned):
+        return np.zeros(1, dtype=np.float32), np.zeros(w_mu.shape, dtype=np.uint8)
+
+    values = w_mu[unpruned].astype(np.float64)
+    precisions = 1. / np.square(w_sigma[unpruned]) if weighted else np.ones_like(values)
+
+    # Initialise with evenly spaced quantiles
+    centroids = np.unique(np.percentile(values, np.linspace(0, 100, num_clusters)))
+
+    for _ in range(num_iterations):
+        # In 1D, the nearest centroid can be found from the midpoints
+        assignments = np.searchsorted((centroids[1:] + centroids[:-1]) / 2., values)
+
+        weights = np.bincount(assignments, weights=precisions, minlength=len(centroids))
+        sums = np.bincount(assignments, weights=precisions * values, minlength=len(centroids))
+
+        # Empty clusters keep their centroid
+        new_centroids = np.where(weights > 0, sums / np.maximum(weights, 1e-300), centroids)
+
+        if np.allclose(new_centroids, centroids):
+            break
+
+        centroids = new_centroids
+
+    assignments = np.searchsorted((centroids[1:] + centroids[:-1]) / 2., values)
+
+    codebook = np.concatenate([[0.], centroids]).astype(np.float32)
+
+    indices = np.zeros(w_mu.shape, dtype=np.uint8)
+    indices[unpruned] = assignments + 1
+
+    return codebook, indices
+
+
+RANS_SCALE_BITS = 16
+RANS_LOWER_BOUND = 1 << 23
+
+
+def quantize_frequencies(probs, scale_bits=RANS_SCALE_BITS):
+    """
+    Integer symbol frequencies that sum to 2^scale_bits, proportional to probs,
+    where every symbol has a frequency of at least 1
+    """
+    total = 1 << scale_bits
+
+    if len(probs) > total:
+        raise ValueError("Cannot code {} symbols with {} bits".format(len(probs), scale_bits))
+
+    probs = np.asarray(probs, dtype=np.float64)
+    probs = probs / np.sum(probs)
+
+    freqs = np.maximum(1, np.floor(probs * (total - len(probs)))).astype(np.int64)
+
+    # The rounding error goes to the most likely symbol
+    freqs[np.argmax(freqs)] += total - np.sum(freqs)
+
+    return freqs
+
+
+def _flat_tables(frequencies):
+    """
+    Concatenates the frequency tables, with the offset of each table, and the
+    cumulative frequency of every symbol
+    """
+    frequencies = [np.asarray(freqs, dtype=np.int64) for freqs in frequencies]
+
+    offsets = np.concatenate([[0], np.cumsum([len(freqs) for freqs in frequencies])[:-1]]).astype(np.int64)
+    cumulative = np.concatenate([np.cumsum(freqs) - freqs for freqs in frequencies])
+
+    return np.concatenate(frequencies), cumulative, offsets
+
+
+def rans_encode(symbols, table_ids, frequencies, scale_bits=RANS_SCALE_BITS):
+    """
+    Entropy codes the symbols with a byte-wise rANS coder (Duda, 2013), where
+    symbol i uses the frequency table frequencies[table_ids[i]] (see
+    quantize_frequencies).
+
+    Returns the code as a uint8 array.
+    """
+    flat_frequencies, flat_cumulative, offsets = _flat_tables(frequencies)
+
+    # Look up the frequencies of all symbols at once, so the coding loop is
+    # only integer arithmetic
+    positions = offsets[np.asarray(table_ids, dtype=np.int64)] + np.asarray(symbols, dtype=np.int64)
+
+    symbol_frequencies = flat_frequencies[positions].tolist()
+    symbol_cumulative = flat_cumulative[positions].tolist()
+
+    renorm_factor = (RANS_LOWER_BOUND >> scale_bits) << 8
+
+    state = RANS_LOWER_BOUND
+    code = bytearray()
+
+    # rANS is last in, first out, so encode in reverse
+    for freq, cumulative in zip(reversed(symbol_frequencies), reversed(symbol_cumulative)):
+
+        while state >= renorm_factor * freq:
+            code.append(state & 0xff)
+            state >>= 8
+
+        state = ((state // freq) << scale_bits) + state % freq + cumulative
+
+    for _ in range(4):
+        code.append(state & 0xff)
+        state >>= 8
+
+    return np.frombuffer(bytes(code[::-1]), dtype=np.uint8)
+
+
+def rans_decode(code, table_ids, frequencies, scale_bits=RANS_SCALE_BITS):
+    """
+    Inverse of rans_encode, the number of symbols is len(table_ids)
+    """
+    flat_frequencies, flat_cumulative, offsets = _flat_tables(frequencies)
+
+    table_ids = np.asarray(table_ids, dtype=np.int64)
+
+    # Symbol of every slot of the tables that are used, so decoding a symbol
+    # is a single lookup instead of a search
+    used_tables = np.unique(table_ids)
+
+    slot_offsets = np.zeros(len(offsets), dtype=np.int64)
+    slot_offsets[used_tables] = np.arange(len(used_tables)) << scale_bits
+
+    slot_symbols = np.concatenate([np.repeat(np.arange(len(frequencies[table_id])),
+                                             frequencies[table_id])
+                                   for table_id in used_tables] or [np.zeros(0)]).astype(np.int64)
+
+    slot_symbols = memoryview(slot_symbols)
+    slot_offsets = slot_offsets[table_ids].tolist()
+    symbol_offsets = offsets[table_ids].tolist()
+
+    flat_frequencies = flat_frequencies.tolist()
+    flat_cumulative = flat_cumulative.tolist()
+
+    code = bytes(np.asarray(code, dtype=np.uint8))
+    mask = (1 << scale_bits) - 1
+
+    state = int.from_bytes(code[:4], "big")
+    position = 4
+
+    symbols = []
+
+    for slot_offset, symbol_offset in zip(slot_offsets, symbol_offsets):
+        slot = state & mask
+
+        symbol = slot_symbols[slot_offset + slot]
+        symbols.append(symbol)
+
+        flat_symbol = symbol_offset + symbol
+
+        state = flat_frequencies[flat_symbol] * (state >> scale_bits) + slot - flat_cumulative[flat_symbol]
+
+        while state < RANS_LOWER_BOUND:
+            state = (state << 8) | code[position]
+            position += 1
+
+    return np.array(symbols, dtype=np.int64)
+
+
+def mixture_cdf(x, loc, mix_prop, sigma1, sigma2):
+    """
+    CDF of the scale mixture prior (a Gaussian if mix_prop is 1)
+    """
+    x = np.asarray(x, dtype=np.float64)
+
+    return mix_prop * ndtr((x - loc) / sigma1) + (1. - mix_prop) * ndtr((x - loc) / sigma2)
+
+
+# Number of precision classes of the entropy coder, class 0 is for pruned
+# weights and class c quantizes with step max|mu| / 2^(c - 1). Weights that
+# need a finer step go to the lossless class ENTROPY_CODING_CLASSES + 1.
+ENTROPY_CODING_CLASSES = 12
+
+
+def _prior_frequencies(cdf, step, num_levels):
+    """
+    Frequencies of the quantized weights k * step, |k| <= num_levels, under the
+    prior. The symbol of k is k + num_levels, and the tails of the prior go to
+    the extreme symbols.
+    """
+    edges = (np.arange(-num_levels, num_levels) + 0.5) * step
+
+    cdfs = np.concatenate([[0.], cdf(edges), [1.]])
+
+    return quantize_frequencies(np.maximum(np.diff(cdfs), 1e-12))
+
+
+def entropy_encode_weights(w_mus, w_sigmas, cdf, tolerance=1.):
+    """
+    Codes the weight means of the layers with the precision their posterior
+    permits, in the spirit of bits-back coding: every weight is quantized to the
+    coarsest step (max|mu| / 2^(c - 1) of its layer) that is at most
+    tolerance * sigma, and the result is entropy coded under the prior with
+    the given CDF. The precision classes are coded with their frequencies
+    in the layer, so the decoder does not need the variances. Weights that
+    would need more than ENTROPY_CODING_CLASSES classes are stored as float32.
+
+    Returns a dict of arrays, and the number of bits of the code (including
+    the float32 weights).
+    """
+    lossless_class = ENTROPY_CODING_CLASSES + 1
+    num_classes = ENTROPY_CODING_CLASSES + 2
+
+    class_symbols, class_tables, class_frequencies = [], [], []
+    value_symbols, value_tables, value_frequencies = [], [], []
+
+    max_abs, outlier_values = [], []
+
+    for i, (w_mu, w_sigma) in enumerate(zip(w_mus, w_sigmas)):
+        w_mu = w_mu.reshape(-1).astype(np.float64)
+        w_sigma = w_sigma.reshape(-1).astype(np.float64)
+
+        unpruned = w_sigma > 0
+        layer_max_abs = np.max(np.abs(w_mu[unpruned])) if np.any(unpruned) else 1.
+        max_abs.append(layer_max_abs)
+
+        # Smallest c with max_abs / 2^(c - 1) <= tolerance * sigma
+        with np.errstate(divide="ignore"):
+            classes = np.ceil(np.log2(layer_max_abs / (tolerance * w_sigma))) + 1
+
+        classes = np.where(unpruned, np.clip(classes, 1, lossless_class), 0).astype(np.int64)
+
+        class_symbols.append(classes)
+        class_tables.append(np.full(len(classes), i))
+        class_frequencies.append(quantize_frequencies(np.bincount(classes, minlength=num_classes) + 1e-3))
+
+        outlier_values.append(w_mu[classes == lossless_class].astype(np.float32))
+
+        for c in range(1, lossless_class):
+            in_class = classes == c
+
+            num_levels = 2**(c - 1)
+            step = layer_max_abs / num_levels
+
+            value_symbols.append(np.round(w_mu[in_class] / step).astype(np.int64) + num_levels)
+            value_tables.append(np.full(np.count_nonzero(in_class), len(value_frequencies)))
+            value_frequencies.append(_prior_frequencies(cdf, step, num_levels))
+
+    class_code = rans_encode(np.concatenate(class_symbols), np.concatenate(class_tables), class_frequencies)
+    value_code = rans_encode(np.concatenate(value_symbols), np.concatenate(value_tables), value_frequencies)
+
+    outlier_values = np.concatenate(outlier_values)
+
+    encoded = {"max_abs": np.array(max_abs),
+               "class_frequencies": np.stack(class_frequencies).astype(np.int32),
+               "class_code": class_code,
+               "value_code": value_code,
+               "outlier_values": outlier_values}
+
+    return encoded, 8 * (len(class_code) + len(value_code) + outlier_values.nbytes)
+
+
+def entropy_decode_weights(encoded, shapes, cdf):
+    """
+    Inverse of entropy_encode_weights, up to the quantization error
+    """
+    lossless_class = ENTROPY_CODING_CLASSES + 1
+
+    sizes = [int(np.prod(shape)) for shape in shapes]
+
+    class_tables = np.concatenate([np.full(size, i) for i, size in enumerate(sizes)])
+    classes = rans_decode(encoded["class_code"], class_tables, list(encoded["class_frequencies"]))
+    classes = np.split(classes, np.cumsum(sizes)[:-1])
+
+    # Values are coded layer by layer, class by class
+    value_tables, value_frequencies, steps = [], [], []
+
+    for layer_classes, layer_max_abs in zip(classes, encoded["max_abs"]):
+        for c in range(1, lossless_class):
+            num_levels = 2**(c - 1)
+            step = layer_max_abs / num_levels
+
+            value_tables.append(np.full(np.count_nonzero(layer_classes == c), len(value_frequencies)))
+            value_frequencies.append(_prior_frequencies(cdf, step, num_levels))
+            steps.append(step)
+
+    values = rans_decode(encoded["value_code"], np.concatenate(value_tables), value_frequencies)
+    values = np.split(values, np.cumsum([len(tables) for tables in value_tables])[:-1])
+
+    # The float32 weights are stored layer by layer
+    outlier_values = np.split(encoded["outlier_values"],
+                              np.cumsum([np.count_nonzero(layer_classes == lossless_class)
+                                         for layer_classes in classes])[:-1])
+
+    w_mus = []
+
+    for i, (layer_classes, shape) in enumerate(zip(classes, shapes)):
+        w_mu = np.zeros(len(layer_classes), dtype=np.float32)
+
+        for c in range(1, lossless_class):
+            table_id = i * ENTROPY_CODING_CLASSES + c - 1
+            num_levels = 2**(c - 1)
+
+            w_mu[layer_classes == c] = (values[table_id] - num_levels) * steps[table_id]
 
+        w_mu[layer_classes == lossless_class] = outlier_values[i]
 
-    print("Old # 0: {}, New # 0: {}, Ratio: {:.2f}%".format(old_num_zeros, num_zeros, 100 * float(num_zeros)/ old_num_zeros))
+        w_mus.append(w_mu.reshape(shape))
 
-    return kept_input_indices, w_mus, w_sigmas, b_mus, b_sigmas
+    return w_mus
 
 
 def densify_weight_matrix(w):
@@ -0,0 +1,551 @@
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from compression import eliminate_dead_neurons, quantize_weights, dequantize_weights, kmeans_codebook, \
+    pack_bits, unpack_bits, entropy_encode_weights, entropy_decode_weights, mixture_cdf
+
+
+# Density below which the sparse format is used. This is a guess that has not
+# been measured on our hardware, use calibrate_density_threshold to measure
+# the crossover for a given layer and batch size.
+DEFAULT_DENSITY_THRESHOLD = 0.1
+
+
+def _check_sample_sigma(w_sigma, b_sigma, sample):
+    if sample and (w_sigma is None or b_sigma is None):
+        raise ValueError("Cannot sample the weights of a layer that was created without w_sigma and b_sigma!")
+
+
+class DenseInferenceLayer(object):
+    """
+    Fully-connected layer with fixed posterior parameters, for inference only
+    """
+
+    def __init__(self, w_mu, b_mu, w_sigma=None, b_sigma=None):
+
+        self.shape = w_mu.shape
+        self.density = np.count_nonzero(w_mu) / float(w_mu.size)
+
+        self._w_mu = tf.convert_to_tensor(w_mu, dtype=tf.float32)
+        self._b_mu = tf.convert_to_tensor(b_mu, dtype=tf.float32)
+
+        self._w_sigma = None if w_sigma is None else tf.convert_to_tensor(w_sigma, dtype=tf.float32)
+        self._b_sigma = None if b_sigma is None else tf.convert_to_tensor(b_sigma, dtype=tf.float32)
+
+    @property
+    def format(self):
+        return "dense"
+
+    def __call__(self, inputs, sample=False):
+
+        _check_sample_sigma(self._w_sigma, self._b_sigma, sample)
+
+        w = self._w_mu
+        b = self._b_mu
+
+        if sample:
+            w = w + self._w_sigma * tf.random_normal(tf.shape(w))
+            b = b + self._b_sigma * tf.random_normal(tf.shape(b))
+
+        return tf.matmul(inputs, w) + b
+
+
+class SparseInferenceLayer(object):
+    """
+    Fully-connected layer that only stores the surviving weights in COO format.
+
+    The weights are stored transposed, since x'W = (W'x)' lets us use the
+    sparse-dense matmul with the sparse operand on the left.
+    """
+
+    def __init__(self, w_mu, b_mu, w_sigma=None, b_sigma=None):
+
+        self.shape = w_mu.shape
+
+        # Pruned weights have 0 mean and (if given) 0 variance
+        surviving = w_mu != 0 if w_sigma is None else (w_mu != 0) | (w_sigma != 0)
+
+        rows, cols = np.nonzero(surviving)
+
+        self.density = len(rows) / float(w_mu.size)
+
+        # Indices of the transpose, in canonical row-major order
+        order = np.lexsort((rows, cols))
+        rows, cols = rows[order], cols[order]
+
+        self._indices = tf.convert_to_tensor(np.stack([cols, rows], axis=1), dtype=tf.int64)
+        self._dense_shape = [w_mu.shape[1], w_mu.shape[0]]
+
+        self._w_mu = tf.convert_to_tensor(w_mu[rows, cols], dtype=tf.float32)
+        self._b_mu = tf.convert_to_tensor(b_mu, dtype=tf.float32)
+
+        self._w_sigma = None if w_sigma is None else tf.convert_to_tensor(w_sigma[rows, cols], dtype=tf.float32)
+        self._b_sigma = None if b_sigma is None else tf.convert_to_tensor(b_sigma, dtype=tf.float32)
+
+    @property
+    def format(self):
+        return "sparse"
+
+    def __call__(self, inputs, sample=False):
+
+        _check_sample_sigma(self._w_sigma, self._b_sigma, sample)
+
+        w_values = self._w_mu
+        b = self._b_mu
+
+        # Only the surviving weights are sampled
+        if sample:
+            w_values = w_values + self._w_sigma * tf.random_normal(tf.shape(w_values))
+            b = b + self._b_sigma * tf.random_normal(tf.shape(b))
+
+        w_transpose = tf.SparseTensor(indices=self._indices,
+                                      values=w_values,
+                                      dense_shape=self._dense_shape)
+
+        # (W'x')' = xW
+        outputs = tf.sparse_tensor_dense_matmul(w_transpose, inputs, adjoint_b=True)
+
+        return tf.transpose(outputs) + b
+
+
+class CodebookInferenceLayer(object):
+    """
+    Fully-connected layer with shared weights: only the codebook and the uint8
+    codebook index of every weight are stored.
+
+    This only saves storage (e.g. of exported models), the weight matrix is
+    gathered from the codebook on every forward pass, so it is never kept in
+    memory between calls. The matmuls cost the same as for a dense layer.
+    """
+
+    def __init__(self, codebook, indices, b_mu):
+
+        self.shape = indices.shape
+        self.density = np.count_nonzero(indices) / float(indices.size)
+
+        self._codebook = tf.convert_to_tensor(codebook, dtype=tf.float32)
+        self._indices = tf.convert_to_tensor(indices, dtype=tf.uint8)
+        self._b_mu = tf.convert_to_tensor(b_mu, dtype=tf.float32)
+
+    @property
+    def format(self):
+        return "codebook"
+
+    def __call__(self, inputs, sample=False):
+
+        if sample:
+            raise ValueError("Codebook layers only store the posterior means!")
+
+        w = tf.gather(self._codebook, tf.cast(self._indices, tf.int32))
+
+        return tf.matmul(inputs, w) + self._b_mu
+
+
+def create_inference_layer(w_mu, b_mu, w_sigma=None, b_sigma=None, density_threshold=DEFAULT_DENSITY_THRESHOLD):
+    """
+    Picks the sparse or dense layer format based on the measured density of
+    the layer: below the density threshold the sparse-dense matmul is assumed
+    to be faster, see calibrate_density_threshold.
+    """
+    density = np.count_nonzero(w_mu if w_sigma is None else (w_mu != 0) | (w_sigma != 0)) / float(w_mu.size)
+
+    if density < density_threshold:
+        return SparseInferenceLayer(w_mu, b_mu, w_sigma, b_sigma)
+
+    return DenseInferenceLayer(w_mu, b_mu, w_sigma, b_sigma)
+
+
+class InferenceModel(object):
+    """
+    Feed-forward network with fixed parameters for fast predictions, e.g.
+    after pruning a VarEstimator. If sample is True (and the variances were
+    given), the weights are sampled from the posterior, otherwise the
+    posterior means are used.
+    """
+
+    def __init__(self, layers, activations, input_indices=None):
+
+        self.layers = layers
+        self.activations = activations
+
+        self._input_indices = None if input_indices is None else \
+            tf.convert_to_tensor(np.asarray(input_indices), dtype=tf.int32)
+
+    @classmethod
+    def from_params(cls,
+                    w_mus,
+                    b_mus,
+                    activations,
+                    w_sigmas=None,
+                    b_sigmas=None,
+                    input_indices=None,
+                    density_threshold=DEFAULT_DENSITY_THRESHOLD):
+
+        if w_sigmas is None:
+            w_sigmas = [None] * len(w_mus)
+            b_sigmas = [None] * len(b_mus)
+
+        layers = [create_inference_layer(w_mu, b_mu, w_sigma, b_sigma,
+                                         density_threshold=density_threshold)
+                  for w_mu, b_mu, w_sigma, b_sigma in zip(w_mus, b_mus, w_sigmas, b_sigmas)]
+
+        return cls(layers, activations, input_indices)
+
+    @classmethod
+    def from_estimator(cls, model, use_sigma=False, density_threshold=DEFAULT_DENSITY_THRESHOLD, num_clusters=None, weighted_clustering=True):
+        """
+        Creates an inference model from a (pruned) VarEstimator. Dead neurons
+        and input features are eliminated first.
+
+        If num_clusters is given, the weights of every layer are shared
+        through a codebook of that size (see compression.kmeans_codebook).
+        """
+        activations = model.activations
+
+        w_mus, w_sigmas, b_mus, b_sigmas = zip(*[layer.get_posterior_params()
+                                                 for layer in model.layers])
+
+        input_indices, w_mus, w_sigmas, b_mus, b_sigmas, _ = \
+            eliminate_dead_neurons(w_mus=w_mus,
+                                   w_sigmas=w_sigmas,
+                                   b_mus=b_mus,
+                                   b_sigmas=b_sigmas,
+                                   activations=activations)
+
+        if num_clusters is not None:
+            layers = [CodebookInferenceLayer(*kmeans_codebook(w_mu, w_sigma,
+                                                              num_clusters=num_clusters,
+                                                              weighted=weighted_clustering),
+                                             b_mu=b_mu)
+                      for w_mu, w_sigma, b_mu in zip(w_mus, w_sigmas, b_mus)]
+
+            return cls(layers, activations, input_indices)
+
+        return cls.from_params(w_mus=w_mus,
+                               b_mus=b_mus,
+                               activations=activations,
+                               w_sigmas=w_sigmas if use_sigma else None,
+                               b_sigmas=b_sigmas if use_sigma else None,
+                               input_indices=input_indices,
+                               density_threshold=density_threshold)
+
+    def summary(self):
+        return "\n".join(["Layer {}: {} {}, density: {:.2f}%".format(
+            i, layer.format, layer.shape, 100 * layer.density)
+            for i, layer in enumerate(self.layers)])
+
+    def __call__(self, inputs, sample=False):
+
+        # Flatten input
+        outputs = tf.reshape(inputs, [tf.shape(inputs)[0], -1])
+
+        if self._input_indices is not None:
+            outputs = tf.gather(outputs, self._input_indices, axis=1)
+
+        for layer, activation in zip(self.layers, self.activations):
+            outputs = activation(layer(outputs, sample=sample))
+
+        return outputs
+
+
+ACTIVATIONS = {
+    "relu": tf.nn.relu,
+    "identity": tf.identity
+}
+
+
+def export_quantized(model, path, dtype="quantized", tolerance=1.):
+    """
+    Saves the posterior means of a (pruned) VarEstimator in a compact .npz
+    file, after eliminating dead neurons. The variances are not stored. The
+    loaded model takes the inputs of the original (uncompressed) model.
+
+    dtype - "float16", or "quantized" for the SNR-aware quantization of
+            compression.quantize_weights, which uses 2 to 8 bits per weight,
+            and float32 for the weights that need more
+    tolerance - the largest quantization step as a multiple of sigma
+
+    Returns the bits per unpruned weight of the file, and the number of
+    float32 outliers.
+    """
+    w_mus, w_sigmas, b_mus, b_sigmas = zip(*[layer.get_posterior_params()
+                                             for layer in model.layers])
+
+    input_indices, w_mus, w_sigmas, b_mus, b_sigmas, _ = \
+        eliminate_dead_neurons(w_mus=w_mus,
+                               w_sigmas=w_sigmas,
+                               b_mus=b_mus,
+                               b_sigmas=b_sigmas,
+                               activations=model.activations)
+
+    arrays = {"dtype": np.array(dtype),
+              "activations": np.array([activation.__name__ for activation in model.activations]),
+              "input_indices": np.asarray(model.original_input_indices(input_indices), dtype=np.int32)}
+
+    num_outliers = 0
+
+    for i, (w_mu, w_sigma, b_mu) in enumerate(zip(w_mus, w_sigmas, b_mus)):
+        prefix = "layer_{}/".format(i)
+
+        arrays[prefix + "shape"] = np.array(w_mu.shape)
+        arrays[prefix + "b_mu"] = b_mu.astype(np.float16)
+
+        if dtype == "float16":
+            arrays[prefix + "w_mu"] = w_mu.astype(np.float16)
+        elif dtype == "quantized":
+            quantized = quantize_weights(w_mu, w_sigma, tolerance=tolerance)
+            num_outliers += len(quantized["outlier_indices"])
+
+            for key, value in quantized.items():
+                arrays[prefix + key] = value
+        else:
+            raise ValueError("Unknown dtype '{}', must be float16 or quantized".format(dtype))
+
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+    num_unpruned = sum([np.count_nonzero(w_sigma) for w_sigma in w_sigmas])
+
+    # The size of the file includes the headers of the .npz archive
+    return 8. * os.path.getsize(path) / max(num_unpruned, 1), num_outliers
+
+
+def load_quantized(path, density_threshold=DEFAULT_DENSITY_THRESHOLD):
+    """
+    Creates an InferenceModel from a file written by export_quantized
+    """
+    with np.load(path) as arrays:
+        dtype = str(arrays["dtype"])
+
+        activations = [ACTIVATIONS[name] for name in arrays["activations"]]
+
+        w_mus, b_mus = [], []
+
+        for i in range(len(activations)):
+            prefix = "layer_{}/".format(i)
+
+            shape = tuple(arrays[prefix + "shape"])
+
+            if dtype == "float16":
+                w_mu = arrays[prefix + "w_mu"].astype(np.float32)
+            else:
+                quantized = {key[len(prefix):]: arrays[key]
+                             for key in arrays.files if key.startswith(prefix)}
+                w_mu = dequantize_weights(quantized, shape)
+
+            w_mus.append(w_mu)
+            b_mus.append(arrays[prefix + "b_mu"].astype(np.float32))
+
+        return InferenceModel.from_params(w_mus=w_mus,
+                                          b_mus=b_mus,
+                                          activations=activations,
+                                          input_indices=arrays["input_indices"],
+                                          density_threshold=density_threshold)
+
+
+def export_codebook(model, path, num_clusters=16, weighted=True):
+    """
+    Saves a (pruned) VarEstimator with weight sharing in a compact .npz file,
+    after eliminating dead neurons: every layer stores its codebook (see
+    compression.kmeans_codebook) and the codebook indices of its weights,
+    packed in as few bits as the codebook size allows. The biases are stored
+    as float16.
+
+    Returns the bits per unpruned weight of the file.
+    """
+    w_mus, w_sigmas, b_mus, b_sigmas = zip(*[layer.get_posterior_params()
+                                             for layer in model.layers])
+
+    input_indices, w_mus, w_sigmas, b_mus, b_sigmas, _ = \
+        eliminate_dead_neurons(w_mus=w_mus,
+                               w_sigmas=w_sigmas,
+                               b_mus=b_mus,
+                               b_sigmas=b_sigmas,
+                               activations=model.activations)
+
+    arrays = {"activations": np.array([activation.__name__ for activation in model.activations]),
+              "input_indices": np.asarray(model.original_input_indices(input_indices), dtype=np.int32)}
+
+    for i, (w_mu, w_sigma, b_mu) in enumerate(zip(w_mus, w_sigmas, b_mus)):
+        prefix = "layer_{}/".format(i)
+
+        codebook, indices = kmeans_codebook(w_mu, w_sigma,
+                                            num_clusters=num_clusters,
+                                            weighted=weighted)
+
+        arrays[prefix + "shape"] = np.array(w_mu.shape)
+        arrays[prefix + "codebook"] = codebook
+        arrays[prefix + "indices"] = pack_bits(indices, _index_bits(len(codebook)))
+        arrays[prefix + "b_mu"] = b_mu.astype(np.float16)
+
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+    num_unpruned = sum([np.count_nonzero(w_sigma) for w_sigma in w_sigmas])
+
+    # The size of the file includes the headers of the .npz archive
+    return 8. * os.path.getsize(path) / max(num_unpruned, 1)
+
+
+def load_codebook(path):
+    """
+    Creates an InferenceModel of codebook layers from a file written by
+    export_codebook
+    """
+    with np.load(path) as arrays:
+        activations = [ACTIVATIONS[name] for name in arrays["activations"]]
+
+        layers = []
+
+        for i in range(len(activations)):
+            prefix = "layer_{}/".format(i)
+
+            shape = tuple(arrays[prefix + "shape"])
+            codebook = arrays[prefix + "codebook"]
+
+            indices = unpack_bits(arrays[prefix + "indices"],
+                                  _index_bits(len(codebook)),
+                                  int(np.prod(shape))).reshape(shape)
+
+            layers.append(CodebookInferenceLayer(codebook=codebook,
+                                                 indices=indices,
+                                                 b_mu=arrays[prefix + "b_mu"].astype(np.float32)))
+
+        return InferenceModel(layers, activations, input_indices=arrays["input_indices"])
+
+
+def _index_bits(codebook_size):
+    """
+    The fewest bits supported by compression.pack_bits that fit every index
+    into a codebook of the given size
+    """
+    return min([bits for bits in (1, 2, 4, 8) if codebook_size <= 2**bits])
+
+
+def _prior_params(prior):
+    """
+    (loc, mix_prop, sigma1, sigma2) of a scale mixture or Gaussian prior
+    """
+    if hasattr(prior, "mix_prop"):
+        return np.array([0., prior.mix_prop, prior.sigma1, prior.sigma2])
+
+    scale = float(prior.scale)
+
+    return np.array([float(prior.loc), 1., scale, scale])
+
+
+def export_entropy_coded(model, path, tolerance=1.):
+    """
+    Saves the posterior means of a (pruned) VarEstimator, quantized with the
+    precision of their posterior and entropy coded under the model's prior
+    (see compression.entropy_encode_weights), after eliminating dead neurons.
+
+    Returns the bits per weight of the code alone, and of the whole file
+    (including the biases, the frequency tables and the scales), over all and
+    over the unpruned weights, and the number of weights stored as float32.
+    """
+    w_mus, w_sigmas, b_mus, b_sigmas = zip(*[layer.get_posterior_params()
+                                             for layer in model.layers])
+
+    input_indices, w_mus, w_sigmas, b_mus, b_sigmas, _ = \
+        eliminate_dead_neurons(w_mus=w_mus,
+                               w_sigmas=w_sigmas,
+                               b_mus=b_mus,
+                               b_sigmas=b_sigmas,
+                               activations=model.activations)
+
+    prior_params = _prior_params(model.prior)
+
+    encoded, num_bits = entropy_encode_weights(w_mus, w_sigmas,
+                                               cdf=lambda x: mixture_cdf(x, *prior_params),
+                                               tolerance=tolerance)
+
+    arrays = {"prior_params": prior_params,
+              "activations": np.array([activation.__name__ for activation in model.activations]),
+              "input_indices": np.asarray(model.original_input_indices(input_indices), dtype=np.int32),
+              "shapes": np.array([w_mu.shape for w_mu in w_mus])}
+
+    arrays.update(encoded)
+
+    for i, b_mu in enumerate(b_mus):
+        arrays["b_mu_{}".format(i)] = b_mu.astype(np.float16)
+
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+    num_weights = sum([w_mu.size for w_mu in w_mus])
+    num_unpruned = sum([np.count_nonzero(w_sigma) for w_sigma in w_sigmas])
+
+    file_bits = 8. * os.path.getsize(path)
+
+    return float(num_bits) / num_weights, file_bits / num_weights, file_bits / max(num_unpruned, 1), \
+        len(encoded["outlier_values"])
+
+
+def load_entropy_coded(path, density_threshold=DEFAULT_DENSITY_THRESHOLD):
+    """
+    Creates an InferenceModel from a file written by export_entropy_coded
+    """
+    with np.load(path) as arrays:
+        prior_params = arrays["prior_params"]
+
+        activations = [ACTIVATIONS[name] for name in arrays["activations"]]
+        shapes = [tuple(shape) for shape in arrays["shapes"]]
+
+        w_mus = entropy_decode_weights(arrays, shapes, cdf=lambda x: mixture_cdf(x, *prior_params))
+        b_mus = [arrays["b_mu_{}".format(i)].astype(np.float32) for i in range(len(shapes))]
+
+        return InferenceModel.from_params(w_mus=w_mus,
+                                          b_mus=b_mus,
+                                          activations=activations,
+                                          input_indices=arrays["input_indices"],
+                                          density_threshold=density_threshold)
+
+
+def measure_latency(model, inputs, num_runs=10):
+    """
+    Average wall time of a forward pass in seconds, after a warm-up run
+    """
+    model(inputs).numpy()
+
+    start = time.time()
+
+    for _ in range(num_runs):
+        # Converting to numpy waits for the result
+        model(inputs).numpy()
+
+    return (time.time() - start) / num_runs
+
+
+def calibrate_density_threshold(input_size, output_size, batch_size,
+                                densities=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5),
+                                num_runs=10):
+    """
+    Measures the dense and sparse latencies of a random input_size x output_size
+    layer at each of the given densities, and returns the highest density at
+    which the sparse layer was still faster (0 if it never was), along with the
+    list of (density, dense latency, sparse latency) measurements.
+    """
+    inputs = tf.convert_to_tensor(np.random.normal(size=(batch_size, input_size)), dtype=tf.float32)
+    b_mu = np.zeros(output_size, dtype=np.float32)
+
+    threshold = 0.
+    measurements = []
+
+    for density in sorted(densities):
+
+        w_mu = np.random.normal(size=(input_size, output_size)).astype(np.float32)
+        w_mu[np.random.uniform(size=w_mu.shape) >= density] = 0.
+
+        dense_latency = measure_latency(DenseInferenceLayer(w_mu, b_mu), inputs, num_runs=num_runs)
+        sparse_latency = measure_latency(SparseInferenceLayer(w_mu, b_mu), inputs, num_runs=num_runs)
+
+        measurements.append((density, dense_latency, sparse_latency))
+
+        if sparse_latency < dense_latency:
+            threshold = density
+
+    return threshold, measurements
@@ -14,6 +14,7 @@ import json
 
 from utils import is_valid_file, setup_eager_checkpoints_and_restore
 from variational import VarRegression
+from training import create_train_step
 
 tf.enable_eager_execution()
 
@@ -59,8 +60,19 @@ def run(args):
         "checkpoint_name": "_ckpt",
         "learning_rate": 1e-3,
         "log_freq": 100,
+        # One of VarLinear.ESTIMATORS
+        "estimator": "weight",
+        # Number of weight samples in the forward pass and ELBO estimate
+        "num_samples": 1,
+        # Number of posterior samples plotted during testing
+        "num_test_samples": 10,
+        # Compile the train step with XLA
+        "jit_compile": False,
     }
 
+    if args.config is not None:
+        config.update(json.load(args.config))
+
     num_batches = config["training_set_size"] / config["batch_size"]
 
     print("Number of batches: {}".format(num_batches))
@@ -82,25 +94,33 @@ def run(args):
     # ==========================================================================
 
     model = models[args.model](units=config["num_units"],
-                               prior=tfp.distributions.Normal(loc=0., scale=0.3))
+                               prior=tfp.distributions.Normal(loc=0., scale=0.3),
+                               estimator=config["estimator"])
 
     # Connect the model computational graph by executing a forward-pass
     model(tf.zeros((1, 1)))
 
     optimizer = tf.train.RMSPropOptimizer(learning_rate=config["learning_rate"])
 
+    train_step = create_train_step(model=model,
+                                   optimizer=optimizer,
+                                   forward=lambda xs: model(xs, num_samples=config["num_samples"]),
+                                   jit_compile=config["jit_compile"])
+
     # ==========================================================================
     # Define Checkpoints
     # ==========================================================================
     global_step = tf.train.get_or_create_global_step()
 
-    trainable_vars = model.get_all_variables() + (global_step,)
+    # This includes non-trainable variables, e.g. the pruning masks
+    checkpoint_vars = model.get_all_variables(collection=tf.GraphKeys.GLOBAL_VARIABLES) + (global_step,)
     checkpoint_dir = os.path.join(args.model_dir, "checkpoints")
 
     checkpoint, ckpt_prefix = setup_eager_checkpoints_and_restore(
-        variables=trainable_vars,
+        variables=checkpoint_vars,
         checkpoint_dir=checkpoint_dir,
-        checkpoint_name=config["checkpoint_name"])
+        checkpoint_name=config["checkpoint_name"],
+        optional_variables=model.mask_variables)
 
     # ==========================================================================
     # Define Tensorboard Summaries
@@ -118,19 +138,10 @@ def run(args):
                     # Increment global step
                     global_step.assign_add(1)
 
-                    # Record gradients of the forward pass
-                    with tf.GradientTape() as tape:
-
-                        logits = model(xs)
+                    kl_coeff = 1. / num_batches
 
-                        kl_coeff = 1. / num_batches
-
-                        # negative ELBO
-                        loss = kl_coeff * model.kl_divergence + model.negative_log_likelihood(logits, tf.reshape(ys, [-1, 1]))
-
-                    # Backprop
-                    grads = tape.gradient(loss, model.get_all_variables())
-                    optimizer.apply_gradients(zip(grads, model.get_all_variables()))
+                    # SGD step on the negative ELBO
+                    loss, _, _, _ = train_step(xs, tf.reshape(ys, [-1, 1]), kl_coeff)
 
                     # =================================
                     # Add summaries for tensorboard
@@ -169,14 +180,14 @@ def run(args):
 
     mus_overall = []
     sigmas_overall = []
-    results_overall = []
-
-    for i in range(10):
-        results = model(tf.convert_to_tensor(xs, dtype=tf.float32))
 
-        results_overall.append(results.numpy())
+    # All posterior samples are drawn in a single forward pass
+    results_overall = model(tf.convert_to_tensor(xs.reshape((-1, 1)), dtype=tf.float32),
+                            num_samples=config["num_test_samples"]).numpy()
 
-    results_overall = np.array(results_overall)
+    # With a single sample there is no leading sample dimension
+    if config["num_test_samples"] == 1:
+        results_overall = np.expand_dims(results_overall, axis=0)
 
     means = np.median(results_overall, axis=0)
     bottom_25 = np.percentile(results_overall, 25, axis=0)
@@ -206,6 +217,8 @@ if __name__ == "__main__":
                     help='Should we just evaluate?')
     parser.add_argument('--model_dir', type=lambda x: is_valid_file(parser, x), default='/tmp/bayes_by_backprop_regression',
                     help='The model directory.')
+    parser.add_argument('--config', type=open, default=None,
+                    help='Path to the config JSON file.')
 
     args = parser.parse_args()
 
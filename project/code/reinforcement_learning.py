@@ -15,27 +15,164 @@ import json
 from utils import is_valid_file, \
     load_mushroom_dataset, \
     generate_new_contexts, \
-    setup_eager_checkpoints_and_restore
-from variational import VarMushroomRL
+    setup_eager_checkpoints_and_restore, \
+    unique_rows, \
+    ReplayBuffer
+from variational import VarMushroomRL, VarMushroomMultiHeadRL
+from training import create_train_step
 
 tf.enable_eager_execution()
 
 models = {
     "baseline": None,
-    "bayes": VarMushroomRL
+    "bayes": VarMushroomRL,
+    "bayes_multi_head": VarMushroomMultiHeadRL
 }
 
-def rl_input_fn(contexts, rewards, batch_size=64, shuffle_size=1000):
-    ds = tf.data.Dataset.from_tensor_slices((contexts, rewards))
+# Not eating / eating
+NUM_ACTIONS = 2
+
+def rl_input_fn(contexts, actions, rewards, batch_size=64, shuffle_size=1000, num_batches=None):
+    """
+    If num_batches is given, exactly that many full minibatches are made by
+    cycling through the data, so that every minibatch has the same shape and
+    a compiled train step is not traced again for a smaller last minibatch.
+    """
+    ds = tf.data.Dataset.from_tensor_slices((contexts, actions, rewards))
     ds = ds.shuffle(shuffle_size)
-    ds = ds.map(lambda data, labels:
-                (tf.cast(data, tf.float32), tf.cast(labels, tf.float32)))
-    ds = ds.batch(batch_size)
+    ds = ds.map(lambda data, actions, labels:
+                (tf.cast(data, tf.float32), tf.cast(actions, tf.int32), tf.cast(labels, tf.float32)))
+
+    if num_batches is None:
+        return ds.batch(batch_size)
+
+    # The last minibatch is padded with examples of the next pass
+    ds = ds.repeat()
+    ds = ds.batch(batch_size, drop_remainder=True)
+    ds = ds.take(num_batches)
 
     return ds
 
 
-def get_action(agent, context, epsilon=0, num_thompson_samples=2):
+def is_multi_head(agent):
+    """
+    Multi-head agents take only the context and predict the reward of every
+    action, single-head agents take the context with a one-hot action attached
+    """
+    return isinstance(agent, VarMushroomMultiHeadRL)
+
+
+def get_num_actions(agent):
+    """
+    Number of actions the agent scores: one per head of a multi-head agent,
+    otherwise the actions of the environment
+    """
+    return agent.num_actions if is_multi_head(agent) else NUM_ACTIONS
+
+
+def action_offsets(num_actions):
+    """
+    Eating (every action but the first) starts with an offset of 1
+    """
+    return [[0.] + [1.] * (num_actions - 1)]
+
+
+def attach_actions(contexts, actions):
+    """
+    Attach the one-hot encoding of the actions at the end of the context vectors
+    """
+    return tf.concat([contexts, tf.one_hot(actions, NUM_ACTIONS, dtype=contexts.dtype)], axis=1)
+
+
+def action_rewards(agent, contexts, num_samples=1):
+    """
+    Predicted reward of every action for every context, using the same weight
+    sample for all actions. The result has shape [num_contexts, num_actions],
+    or [num_samples, num_contexts, num_actions] if num_samples > 1.
+    """
+
+    if is_multi_head(agent):
+        return agent(contexts, num_samples=num_samples)
+
+    # Stack all (context, action) pairs, so they are scored in a single pass
+    num_contexts = contexts.shape[0].value
+
+    inputs = tf.concat([attach_actions(contexts, tf.fill([num_contexts], action))
+                        for action in range(NUM_ACTIONS)], axis=0)
+
+    rewards = agent(inputs, num_samples=num_samples)
+
+    sample_shape = [] if num_samples == 1 else [num_samples]
+    rewards = tf.reshape(rewards, sample_shape + [NUM_ACTIONS, num_contexts])
+
+    # Swap the action and context dimensions
+    perm = list(range(len(sample_shape))) + [len(sample_shape) + 1, len(sample_shape)]
+
+    return tf.transpose(rewards, perm)
+
+
+def unique_action_rewards(agent, contexts, num_samples=1):
+    """
+    Same as action_rewards, but every distinct context is only passed through
+    the agent once, and the results are scattered back to the whole batch.
+    Contexts are drawn with replacement from a finite set of mushrooms, so a
+    batch usually contains many duplicates.
+
+    :param contexts: Contexts to score
+    :type contexts: [num_contexts x context_size] numpy array
+    """
+    unique_contexts, inverse = unique_rows(contexts)
+
+    rewards = action_rewards(agent,
+                             tf.convert_to_tensor(unique_contexts, dtype=tf.float32),
+                             num_samples=num_samples)
+
+    # The context dimension is the second to last one
+    return tf.gather(rewards, inverse, axis=rewards.shape.ndims - 2)
+
+
+def predictive_moments(agent, contexts, num_samples=10):
+    """
+    Mean and variance of the predicted reward of every action for every
+    context, estimated from num_samples weight samples. Both have shape
+    [num_contexts, num_actions] and are computed once per distinct context.
+    """
+    unique_contexts, inverse = unique_rows(contexts)
+
+    rewards = action_rewards(agent,
+                             tf.convert_to_tensor(unique_contexts, dtype=tf.float32),
+                             num_samples=num_samples)
+
+    if num_samples == 1:
+        rewards = tf.expand_dims(rewards, 0)
+
+    mean, variance = tf.nn.moments(rewards, axes=[0])
+
+    return tf.gather(mean, inverse), tf.gather(variance, inverse)
+
+
+def taken_action_rewards(agent, contexts, actions, num_samples=1):
+    """
+    Predicted reward of the actions that were actually taken, with shape
+    [batch_size, 1], or [num_samples, batch_size, 1] if num_samples > 1.
+    """
+
+    if is_multi_head(agent):
+        rewards = agent(contexts, num_samples=num_samples)
+
+        return tf.reduce_sum(rewards * tf.one_hot(actions, get_num_actions(agent), dtype=rewards.dtype),
+                             axis=-1,
+                             keepdims=True)
+
+    return agent(attach_actions(contexts, actions), num_samples=num_samples)
+
+
+def get_action(agent,
+               context,
+               epsilon=0,
+               num_thompson_samples=2,
+               greedy=False,
+               deduplicate=True):
     """
     Get the next action as an index (beginning at 0) based on the agent
     and the context vector.
@@ -45,67 +182,119 @@ def get_action(agent, context, epsilon=0, num_thompson_samples=2):
 
     :param context: Context vector from the UCI mushrooms dataset
     :type context: [context_size x 1] numpy array
+
+    :param greedy: Act greedily w.r.t. the predictive mean instead of Thompson sampling
+    :type greedy: bool
+
+    :param deduplicate: Score every distinct context only once
+    :type deduplicate: bool
     """
 
     num_contexts = context.shape[0]
+    num_actions = get_num_actions(agent)
 
-    # Attach one-hot encoding of actions at the end of context vector
-    no_eat_action = np.hstack([context, np.ones((num_contexts, 1)), np.zeros((num_contexts, 1))])
-    eat_action = np.hstack([context, np.zeros((num_contexts, 1)), np.ones((num_contexts, 1))])
+    if greedy:
+        rewards, _ = predictive_moments(agent, context, num_samples=num_thompson_samples)
 
-    no_eat_rewards = 0
-    eat_rewards = 1
-
-    # Do Thompson sampling
-    for i in range(num_thompson_samples):
+    else:
+        # Do Thompson sampling: every weight sample is shared by all actions
+        if deduplicate:
+            rewards = unique_action_rewards(agent, context, num_samples=num_thompson_samples)
+        else:
+            rewards = action_rewards(agent,
+                                     tf.convert_to_tensor(context, dtype=tf.float32),
+                                     num_samples=num_thompson_samples)
 
-        no_eat_rewards += agent(tf.convert_to_tensor(no_eat_action, dtype=tf.float32)).numpy()
-        eat_rewards += agent(tf.convert_to_tensor(eat_action, dtype=tf.float32)).numpy()
+        if num_thompson_samples > 1:
+            rewards = tf.reduce_sum(rewards, axis=0)
 
-    rewards = np.hstack([no_eat_rewards, eat_rewards])
+    # Eating starts with an offset of 1, for both policies
+    rewards += action_offsets(num_actions)
 
     # Epsilon-greedy policy
-    # Start completely greedy
-    action = np.argmax(rewards, axis=1)
+    # Start completely greedy. This is the only point where we sync with the host
+    action = np.array(tf.argmax(rewards, axis=1))
 
     # Select indices to update
     rand_indices = np.random.uniform(low=0., high=1., size=num_contexts) < epsilon
 
     # Select random actions
-    rand_actions = np.random.choice([0, 1], size=num_contexts)
+    rand_actions = np.random.randint(num_actions, size=num_contexts)
 
     action[rand_indices] = rand_actions[rand_indices]
 
     return action
 
 
-def update_agent(agent, optimizer, contexts, rewards, epoch, config):
+def sample_minibatches(replay_buffer, batch_size, num_steps):
+    """
+    Draws num_steps random minibatches from the replay buffer
+    """
+    for _ in range(num_steps):
+        contexts, actions, rewards = replay_buffer.sample(batch_size)
+
+        yield (tf.convert_to_tensor(contexts),
+               tf.convert_to_tensor(actions),
+               tf.convert_to_tensor(rewards))
+
+
+def create_agent_train_step(agent, optimizer, config):
+    """
+    Compiled SGD step on the rewards of the taken actions
+    """
+    return create_train_step(model=agent,
+                             optimizer=optimizer,
+                             forward=lambda inputs: taken_action_rewards(agent,
+                                                                         *inputs,
+                                                                         num_samples=config["num_samples"]),
+                             jit_compile=config["jit_compile"])
+
+
+def update_agent(agent, optimizer, replay_buffer, epoch, config, train_step=None):
     """
-    Updating the agent is just performing a single epoch of SGD
+    Updating the agent is performing SGD on the contents of the replay buffer.
+    Depending on config["update_mode"], this is either
+     - "epoch": a single epoch over the whole replay buffer, or
+     - "steps": a fixed number of steps (config["num_update_steps"]) on random
+       minibatches, so that the cost of an update does not grow with the buffer
+
+    train_step should be created once with create_agent_train_step and passed
+    in, so that it is not compiled again for every update.
     """
+    if train_step is None:
+        train_step = create_agent_train_step(agent, optimizer, config)
+
     global_step = tf.train.get_or_create_global_step()
 
-    num_batches = len(contexts) // config["batch_size"] + 1
+    # The KL is weighted by the number of minibatches in the replay buffer
+    num_buffer_batches = len(replay_buffer) // config["batch_size"] + 1
 
-    with tqdm(total=num_batches) as pbar:
-        for context, reward in rl_input_fn(contexts=contexts,
-                                           rewards=rewards):
-            # Increment global step
-            global_step.assign_add(1)
+    if config["update_mode"] == "steps":
+        num_batches = config["num_update_steps"]
 
-            # Record gradients of the forward pass
-            with tf.GradientTape() as tape:
+        minibatches = sample_minibatches(replay_buffer,
+                                         batch_size=config["batch_size"],
+                                         num_steps=num_batches)
+    elif config["update_mode"] == "epoch":
+        num_batches = -(-len(replay_buffer) // config["batch_size"])
 
-                logits = agent(context)
+        minibatches = rl_input_fn(contexts=replay_buffer.contexts,
+                                  actions=replay_buffer.actions,
+                                  rewards=replay_buffer.rewards,
+                                  batch_size=config["batch_size"],
+                                  num_batches=num_batches)
+    else:
+        raise ValueError("Unknown update mode: {}".format(config["update_mode"]))
 
-                kl_coeff = 1. / num_batches
+    with tqdm(total=num_batches) as pbar:
+        for context, action, reward in minibatches:
+            # Increment global step
+            global_step.assign_add(1)
 
-                # negative ELBO
-                loss = kl_coeff * agent.kl_divergence + agent.negative_log_likelihood(logits, reward)
+            kl_coeff = 1. / num_buffer_batches
 
-            # Backprop
-            grads = tape.gradient(loss, agent.get_all_variables())
-            optimizer.apply_gradients(zip(grads, agent.get_all_variables()))
+            # SGD step on the negative ELBO
+            loss, _, _, _ = train_step((context, action), reward, kl_coeff)
 
             # =================================
             # Add summaries for tensorboard
@@ -140,8 +329,25 @@ def run(args):
         "log_freq": 100,
         "num_units": 400,
         "learning_rate": 1e-3,
+        # One of VarLinear.ESTIMATORS
+        "estimator": "weight",
+        # Number of weight samples in the forward pass and ELBO estimate
+        "num_samples": 1,
+        "num_thompson_samples": 2,
+        # "epoch" or "steps", see update_agent
+        "update_mode": "epoch",
+        "num_update_steps": 16,
+        # Only pass distinct contexts through the agent when acting
+        "deduplicate_contexts": True,
+        # Compile the train step with XLA
+        "jit_compile": False,
+        # Where the preprocessed dataset is cached, None for the default
+        "dataset_cache_dir": None,
     }
 
+    if args.config is not None:
+        config.update(json.load(args.config))
+
     model = models[args.model]
 
     num_batches = config["max_steps"] // config["update_every"]
@@ -150,7 +356,7 @@ def run(args):
     # Loading in the dataset
     # ==========================================================================
 
-    dataset = load_mushroom_dataset()
+    dataset = load_mushroom_dataset(cache_dir=config["dataset_cache_dir"])
 
     data, oracle_reward, oracle_actions, is_edible = generate_new_contexts(
         dataset=dataset,
@@ -163,26 +369,31 @@ def run(args):
     # Define the model
     # ==========================================================================
 
-    agent = VarMushroomRL(units=config["num_units"],
-                          prior=tfp.distributions.Normal(loc=0., scale=0.3))
+    agent = model(units=config["num_units"],
+                  prior=tfp.distributions.Normal(loc=0., scale=0.3),
+                  estimator=config["estimator"])
 
     # Connect the model computational graph by executing a forward-pass
-    agent(tf.zeros((1, config["context_size"] + 2), dtype=tf.float32))
+    action_rewards(agent, tf.zeros((1, config["context_size"]), dtype=tf.float32))
 
     optimizer = tf.train.RMSPropOptimizer(learning_rate=config["learning_rate"])
 
+    train_step = create_agent_train_step(agent, optimizer, config)
+
     # ==========================================================================
     # Define Checkpoints
     # ==========================================================================
 
     global_step = tf.train.get_or_create_global_step()
 
-    trainable_vars = agent.get_all_variables() + (global_step,)
+    # This includes non-trainable variables, e.g. the pruning masks
+    checkpoint_vars = agent.get_all_variables(collection=tf.GraphKeys.GLOBAL_VARIABLES) + (global_step,)
     checkpoint_dir = os.path.join(args.model_dir, "checkpoints")
 
-    checkpoint, ckpt_prefix = setup_eager_checkpoints_and_restore(variables=trainable_vars,
+    checkpoint, ckpt_prefix = setup_eager_checkpoints_and_restore(variables=checkpoint_vars,
                                                                   checkpoint_dir=checkpoint_dir,
-                                                                  checkpoint_name=config["checkpoint_name"])
+                                                                  checkpoint_name=config["checkpoint_name"],
+                                                                  optional_variables=agent.mask_variables)
 
     # ==========================================================================
     # Perform task
@@ -195,8 +406,8 @@ def run(args):
 
     steps = 1
 
-    rewards = None
-    replay_buffer = None
+    replay_buffer = ReplayBuffer(capacity=config["replay_buffer_size"],
+                                 context_size=config["context_size"])
 
     cumulative_reward = 0
     cum_rewards = []
@@ -255,7 +466,12 @@ def run(args):
         if total_batch_index <= config["num_warmup_batches"]:
             action = np.random.choice([0, 1], batch_size)
         else:
-            action = get_action(agent, context, epsilon=args.eps)
+            action = get_action(agent,
+                                context,
+                                epsilon=args.eps,
+                                num_thompson_samples=config["num_thompson_samples"],
+                                greedy=args.greedy,
+                                deduplicate=config["deduplicate_contexts"])
 
         # Assume we haven't eaten anything, correct where needed
         reward = no_eat_reward[ start_idx: end_idx, :]
@@ -271,32 +487,16 @@ def run(args):
         cumulative_regret += regret
         cum_regrets.append(cumulative_regret)
 
-        action_vec = np.zeros((batch_size, 2))
-        action_vec[action == 0, 0] = 1
-        action_vec[action == 1, 1] = 1
-        feature_vec = np.hstack([context, action_vec])
-
-
-        if replay_buffer is None:
-            replay_buffer = feature_vec
-            rewards = reward
-        else:
-            replay_buffer = np.vstack([replay_buffer, feature_vec])
-            rewards = np.vstack([rewards, reward])
-
-        # Prune the replay buffer
-        if replay_buffer.shape[0] > config["replay_buffer_size"]:
-            replay_buffer = replay_buffer[-config["replay_buffer_size"]:, :]
-            rewards = rewards[-config["replay_buffer_size"]:, :]
-
+        # Once full, this overwrites the oldest entries of the replay buffer
+        replay_buffer.append(context, action, reward)
 
         # Update the agent's value function
         update_agent(agent=agent,
                      optimizer=optimizer,
-                     contexts=replay_buffer,
-                     rewards=np.array(rewards),
+                     replay_buffer=replay_buffer,
                      epoch=total_batch_index,
-                     config=config)
+                     config=config,
+                     train_step=train_step)
         checkpoint.save(ckpt_prefix)
 
         oracle_stats["tp"] += sum((action == 1) & (oracle_actions[start_idx:end_idx] == 1))
@@ -368,12 +568,16 @@ if __name__ == "__main__":
 
     parser.add_argument('--eps', type=float, default=0.0,
                         help='Epsilon for the Eps-Greedy policy')
+    parser.add_argument('--greedy', action="store_true", dest="greedy", default=False,
+                        help='Act greedily w.r.t. the predictive mean instead of Thompson sampling')
     parser.add_argument('--model', choices=list(models.keys()), default='bayes',
                     help='The model to train.')
     parser.add_argument('--no_training', action="store_false", dest="is_training", default=True,
                     help='Should we just evaluate?')
     parser.add_argument('--model_dir', type=lambda x: is_valid_file(parser, x), default='/tmp/bayes_by_backprop_rl',
                     help='The model directory.')
+    parser.add_argument('--config', type=open, default=None,
+                    help='Path to the config JSON file.')
 
     args = parser.parse_args()
 
@@ -0,0 +1,93 @@
+import numpy as np
+
+from compression import eliminate_dead_neurons, count_pruned
+
+
+def relu(x):
+    return np.maximum(x, 0.)
+
+
+def identity(x):
+    return x
+
+
+def forward(inputs, w_mus, b_mus, activations):
+    outputs = inputs
+
+    for w_mu, b_mu, activation in zip(w_mus, b_mus, activations):
+        outputs = activation(np.dot(outputs, w_mu) + b_mu)
+
+    return outputs
+
+
+def pruned_network(rng, sizes, pruned_fraction):
+    w_mus, w_sigmas, b_mus, b_sigmas = [], [], [], []
+
+    for input_size, output_size in zip(sizes[:-1], sizes[1:]):
+        w_mask = rng.uniform(size=(input_size, output_size)) >= pruned_fraction
+        b_mask = rng.uniform(size=output_size) >= pruned_fraction
+
+        w_mus.append(np.where(w_mask, rng.normal(size=w_mask.shape), 0.))
+        w_sigmas.append(np.where(w_mask, 0.1, 0.))
+        b_mus.append(np.where(b_mask, rng.normal(size=b_mask.shape), 0.))
+        b_sigmas.append(np.where(b_mask, 0.1, 0.))
+
+    return w_mus, w_sigmas, b_mus, b_sigmas
+
+
+def test_elimination_preserves_outputs():
+    rng = np.random.RandomState(0)
+
+    sizes = [30, 20, 20, 5]
+    activations = [relu, relu, identity]
+
+    for pruned_fraction in (0.5, 0.8, 0.9):
+        w_mus, w_sigmas, b_mus, b_sigmas = pruned_network(rng, sizes, pruned_fraction)
+
+        # A neuron without incoming weights, whose constant output is absorbed
+        w_mus[0][:, 3] = 0.
+        w_sigmas[0][:, 3] = 0.
+        b_mus[0][3] = 2.
+        b_sigmas[0][3] = 0.1
+
+        # A neuron without outgoing weights
+        w_mus[1][7, :] = 0.
+        w_sigmas[1][7, :] = 0.
+
+        input_indices, new_w_mus, new_w_sigmas, new_b_mus, new_b_sigmas, report = \
+            eliminate_dead_neurons(w_mus, w_sigmas, b_mus, b_sigmas, activations)
+
+        inputs = rng.normal(size=(64, sizes[0]))
+
+        np.testing.assert_allclose(forward(inputs[:, input_indices], new_w_mus, new_b_mus, activations),
+                                   forward(inputs, w_mus, b_mus, activations),
+                                   rtol=1e-10,
+                                   atol=1e-10)
+
+        # Output units are kept, and every remaining neuron is alive
+        assert new_w_mus[-1].shape[1] == sizes[-1]
+
+        for w_sigma in new_w_sigmas:
+            assert np.all(np.any(w_sigma != 0, axis=1))
+
+        for w_sigma in new_w_sigmas[:-1]:
+            assert np.all(np.any(w_sigma != 0, axis=0))
+
+        assert report.layer_shapes == [w_mu.shape for w_mu in new_w_mus]
+        assert report.new_num_zeros == count_pruned(new_w_mus, new_w_sigmas, new_b_mus, new_b_sigmas)
+        assert report.new_num_zeros <= report.old_num_zeros
+
+
+def test_elimination_without_dead_neurons():
+    rng = np.random.RandomState(1)
+
+    w_mus, w_sigmas, b_mus, b_sigmas = pruned_network(rng, [10, 8, 3], pruned_fraction=0.)
+
+    input_indices, new_w_mus, _, new_b_mus, _, report = \
+        eliminate_dead_neurons(w_mus, w_sigmas, b_mus, b_sigmas, [relu, identity])
+
+    assert input_indices == list(range(10))
+    assert report.num_iterations == 1
+
+    for w_mu, new_w_mu in zip(w_mus, new_w_mus):
+        np.testing.assert_array_equal(new_w_mu, w_mu)
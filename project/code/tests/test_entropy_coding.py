@@ -0,0 +1,99 @@
+import numpy as np
+
+from compression import rans_encode, rans_decode, quantize_frequencies, mixture_cdf, \
+    entropy_encode_weights, entropy_decode_weights, RANS_SCALE_BITS
+
+
+def random_layers(rng, shapes, pruned_fraction=0.5):
+    w_mus, w_sigmas = [], []
+
+    for shape in shapes:
+        w_sigma = np.abs(rng.normal(size=shape)) * 10**rng.uniform(-7, -1, size=shape)
+        w_sigma[rng.uniform(size=shape) < pruned_fraction] = 0.
+
+        w_mu = np.where(w_sigma > 0, rng.normal(scale=0.1, size=shape), 0.)
+
+        w_mus.append(w_mu.astype(np.float32))
+        w_sigmas.append(w_sigma.astype(np.float32))
+
+    return w_mus, w_sigmas
+
+
+def test_quantize_frequencies():
+    freqs = quantize_frequencies([0.5, 0.25, 1e-9, 0.25])
+
+    assert np.sum(freqs) == 2**RANS_SCALE_BITS
+    assert np.all(freqs >= 1)
+
+
+def test_rans_round_trip():
+    rng = np.random.RandomState(0)
+
+    frequencies = [quantize_frequencies(rng.uniform(size=5)),
+                   quantize_frequencies([1., 1e-6, 1e-6]),
+                   quantize_frequencies(rng.uniform(size=300))]
+
+    table_ids = rng.randint(len(frequencies), size=5000)
+    symbols = np.array([rng.randint(len(frequencies[table_id])) for table_id in table_ids])
+
+    code = rans_encode(symbols, table_ids, frequencies)
+
+    assert code.dtype == np.uint8
+    np.testing.assert_array_equal(rans_decode(code, table_ids, frequencies), symbols)
+
+
+def test_rans_empty():
+    frequencies = [quantize_frequencies([1., 1.])]
+
+    code = rans_encode([], [], frequencies)
+
+    assert len(rans_decode(code, [], frequencies)) == 0
+
+
+def test_mixture_cdf():
+    x = np.linspace(-1., 1., 101)
+
+    cdf = mixture_cdf(x, 0., 0.3, 0.5, 0.01)
+
+    assert np.all(np.diff(cdf) >= 0)
+    np.testing.assert_allclose(cdf[50], 0.5)
+    np.testing.assert_allclose(cdf + cdf[::-1], 1.)
+
+
+def test_entropy_coding_meets_tolerance():
+    rng = np.random.RandomState(1)
+
+    w_mus, w_sigmas = random_layers(rng, [(100, 50), (50, 10)])
+    shapes = [w_mu.shape for w_mu in w_mus]
+
+    cdf = lambda x: mixture_cdf(x, 0., 0.5, 0.1, 0.001)
+
+    for tolerance in (0.5, 1., 4.):
+        encoded, num_bits = entropy_encode_weights(w_mus, w_sigmas, cdf, tolerance=tolerance)
+        decoded = entropy_decode_weights(encoded, shapes, cdf)
+
+        assert num_bits > 0
+
+        for w_mu, w_sigma, w_decoded in zip(w_mus, w_sigmas, decoded):
+            unpruned = w_sigma > 0
+
+            assert w_decoded.shape == w_mu.shape
+            np.testing.assert_array_equal(w_decoded[~unpruned], 0.)
+
+            # Rounding to a step of at most tolerance * sigma, up to float32 rounding
+            error = np.abs(w_decoded - w_mu)[unpruned]
+            bound = 0.5 * tolerance * w_sigma[unpruned] + 1e-6 * np.abs(w_mu[unpruned])
+
+            assert np.all(error <= bound)
+
+
+def test_entropy_coding_all_pruned():
+    w_mus = [np.zeros((4, 3), dtype=np.float32)]
+    w_sigmas = [np.zeros((4, 3), dtype=np.float32)]
+
+    cdf = lambda x: mixture_cdf(x, 0., 1., 0.1, 0.1)
+
+    encoded, _ = entropy_encode_weights(w_mus, w_sigmas, cdf)
+    decoded, = entropy_decode_weights(encoded, [(4, 3)], cdf)
+
+    np.testing.assert_array_equal(decoded, 0.)
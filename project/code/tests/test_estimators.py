@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("tensorflow_probability")
+pytest.importorskip("sonnet")
+
+if not tf.executing_eagerly():
+    tf.enable_eager_execution()
+
+from variational import VarLinear, create_gaussian_prior
+
+
+NUM_SAMPLES = 4000
+
+
+def create_layer(estimator, w_mu, w_sigma, w_mask, b_mu, b_sigma):
+    """
+    A connected VarLinear with the given posterior
+    """
+    initializers = {"w_mu": tf.constant_initializer(w_mu),
+                    "w_rho": tf.constant_initializer(np.log(np.expm1(w_sigma))),
+                    "w_mask": tf.constant_initializer(w_mask),
+                    "b_mu": tf.constant_initializer(b_mu),
+                    "b_rho": tf.constant_initializer(np.log(np.expm1(b_sigma)))}
+
+    layer = VarLinear(output_size=w_mu.shape[1],
+                      prior=create_gaussian_prior({"mu": 0., "sigma": 0.}),
+                      estimator=estimator,
+                      initializers=initializers,
+                      name=estimator)
+
+    layer(tf.zeros((1, w_mu.shape[0])))
+
+    return layer
+
+
+@pytest.mark.parametrize("estimator", ["weight", "local_reparam", "flipout"])
+def test_output_moments(estimator):
+    """
+    Every estimator has the marginals of the naive one, a ~ N(x'mu + b_mu,
+    (x^2)'sigma^2 + b_sigma^2) for every example, where pruned weights count
+    as 0
+    """
+    rng = np.random.RandomState(0)
+
+    input_size, output_size = 6, 3
+
+    w_mu = rng.normal(size=(input_size, output_size)).astype(np.float32)
+    w_sigma = rng.uniform(0.1, 1., size=(input_size, output_size)).astype(np.float32)
+    w_mask = (rng.uniform(size=(input_size, output_size)) > 0.3).astype(np.float32)
+    b_mu = rng.normal(size=output_size).astype(np.float32)
+    b_sigma = rng.uniform(0.1, 1., size=output_size).astype(np.float32)
+
+    inputs = rng.normal(size=(4, input_size)).astype(np.float32)
+
+    layer = create_layer(estimator, w_mu, w_sigma, w_mask, b_mu, b_sigma)
+
+    outputs = layer(tf.convert_to_tensor(inputs), num_samples=NUM_SAMPLES).numpy()
+
+    assert outputs.shape == (NUM_SAMPLES, 4, output_size)
+
+    mean = np.dot(inputs, w_mu * w_mask) + b_mu
+    var = np.dot(np.square(inputs), np.square(w_sigma * w_mask)) + np.square(b_sigma)
+
+    # Within 5 standard errors of the sample mean and variance
+    assert np.all(np.abs(np.mean(outputs, axis=0) - mean) < 5 * np.sqrt(var / NUM_SAMPLES))
+    assert np.all(np.abs(np.var(outputs, axis=0) - var) < 5 * var * np.sqrt(2. / NUM_SAMPLES))
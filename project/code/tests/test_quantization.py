@@ -0,0 +1,59 @@
+import numpy as np
+
+from compression import pack_bits, unpack_bits, quantize_weights, dequantize_weights
+
+
+def test_pack_bits_round_trip():
+    rng = np.random.RandomState(0)
+
+    for bits in (1, 2, 4, 8):
+        values = rng.randint(2**bits, size=101)
+
+        packed = pack_bits(values, bits)
+
+        assert packed.dtype == np.uint8
+        assert len(packed) == -(-len(values) * bits // 8)
+        np.testing.assert_array_equal(unpack_bits(packed, bits, len(values)), values)
+
+
+def test_quantization_meets_tolerance():
+    rng = np.random.RandomState(1)
+
+    shape = (60, 40)
+
+    # Sigmas over several orders of magnitude, so every precision class and
+    # the float32 outliers are used
+    w_sigma = np.abs(rng.normal(size=shape)) * 10**rng.uniform(-6, 0, size=shape)
+    w_sigma[rng.uniform(size=shape) < 0.3] = 0.
+
+    w_mu = np.where(w_sigma > 0, rng.normal(size=shape), 0.)
+
+    unpruned = w_sigma > 0
+
+    for tolerance in (0.5, 1., 4.):
+        quantized = quantize_weights(w_mu, w_sigma, tolerance=tolerance)
+        w_dequantized = dequantize_weights(quantized, shape)
+
+        assert w_dequantized.shape == shape
+        np.testing.assert_array_equal(w_dequantized[~unpruned], 0.)
+
+        error = np.abs(w_dequantized - w_mu)[unpruned]
+        bound = 0.5 * tolerance * w_sigma[unpruned] + 1e-6 * np.abs(w_mu[unpruned])
+
+        assert np.all(error <= bound)
+
+
+def test_quantization_outliers_are_exact():
+    w_mu = np.array([[1., -0.5], [0.25, 0.]])
+    w_sigma = np.array([[1e-9, 1.], [1., 0.]])
+
+    quantized = quantize_weights(w_mu, w_sigma)
+
+    np.testing.assert_array_equal(quantized["outlier_indices"], [0])
+    assert dequantize_weights(quantized, w_mu.shape)[0, 0] == np.float32(1.)
+
+
+def test_quantization_all_pruned():
+    quantized = quantize_weights(np.zeros((3, 5)), np.zeros((3, 5)))
+
+    np.testing.assert_array_equal(dequantize_weights(quantized, (3, 5)), 0.)
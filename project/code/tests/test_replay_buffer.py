@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("pandas")
+
+from utils import ReplayBuffer
+
+
+def entries(start, stop):
+    """
+    Entries whose context, action and reward all identify them
+    """
+    ids = np.arange(start, stop)
+
+    return np.stack([ids, -ids], axis=1).astype(np.float32), ids.astype(np.int32), ids.astype(np.float32)
+
+
+def stored_ids(buffer):
+    ids = buffer.actions
+
+    np.testing.assert_array_equal(buffer.contexts[:, 0], ids)
+    np.testing.assert_array_equal(buffer.contexts[:, 1], -ids)
+    np.testing.assert_array_equal(buffer.rewards[:, 0], ids)
+
+    return sorted(ids.tolist())
+
+
+def test_append_wraps_around():
+    buffer = ReplayBuffer(capacity=5, context_size=2)
+
+    buffer.append(*entries(0, 3))
+
+    assert len(buffer) == 3
+    assert stored_ids(buffer) == [0, 1, 2]
+
+    # Overwrites the two oldest entries
+    buffer.append(*entries(3, 7))
+
+    assert len(buffer) == 5
+    assert stored_ids(buffer) == [2, 3, 4, 5, 6]
+
+    buffer.append(*entries(7, 8))
+
+    assert stored_ids(buffer) == [3, 4, 5, 6, 7]
+
+
+def test_append_more_than_capacity():
+    buffer = ReplayBuffer(capacity=5, context_size=2)
+
+    buffer.append(*entries(0, 2))
+    buffer.append(*entries(2, 14))
+
+    assert len(buffer) == 5
+    assert stored_ids(buffer) == [9, 10, 11, 12, 13]
+
+
+def test_sample():
+    np.random.seed(0)
+
+    buffer = ReplayBuffer(capacity=5, context_size=2)
+
+    buffer.append(*entries(0, 8))
+
+    contexts, actions, rewards = buffer.sample(100)
+
+    assert contexts.shape == (100, 2)
+    assert actions.shape == (100,)
+    assert rewards.shape == (100, 1)
+
+    # Only stored entries are drawn, and their parts stay together
+    assert set(actions.tolist()) <= {3, 4, 5, 6, 7}
+    np.testing.assert_array_equal(contexts[:, 0], actions)
+    np.testing.assert_array_equal(rewards[:, 0], actions)
+
+    # The minibatch is a copy
+    contexts[:] = -1.
+
+    assert stored_ids(buffer) == [3, 4, 5, 6, 7]
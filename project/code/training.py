@@ -0,0 +1,104 @@
+import tensorflow as tf
+
+from variational import VarEstimator
+
+tfe = tf.contrib.eager
+
+
+def create_train_step(model, optimizer, forward=None, compiled=True, jit_compile=False):
+    """
+    Creates the SGD step on the negative ELBO
+
+        loss = kl_coeff * KL(q || p) + NLL(forward(inputs), labels)
+
+    that is shared by the training loops. The model must be connected already.
+
+    model - the (variational) model, it provides kl_divergence and
+            negative_log_likelihood
+    forward - maps the inputs to the outputs for the likelihood, defaults to
+              the model itself. inputs can be a tuple of tensors.
+    compiled - trace the step into a graph function with tfe.defun, so a
+               minibatch is a single call instead of op-by-op dispatch
+    jit_compile - additionally compile the ops of the step with XLA
+
+    Returns train_step(inputs, labels, kl_coeff), which returns the loss, the
+    weighted KL, the NLL and the outputs. For variational models, the pruned
+    parameters and their optimizer slots are re-zeroed after every update.
+    """
+
+    if forward is None:
+        forward = model
+
+    # Variational layers keep the KL of their last forward pass
+    layers = model.layers if isinstance(model, VarEstimator) else []
+
+    def train_step(inputs, labels, kl_coeff):
+
+        # Record gradients of the forward pass
+        with tf.GradientTape() as tape:
+
+            outputs = forward(inputs)
+
+            kl_divergence = kl_coeff * model.kl_divergence
+            neg_log_prob = model.negative_log_likelihood(outputs, labels)
+
+            # negative ELBO
+            loss = kl_divergence + neg_log_prob
+
+        # Backprop
+        variables = model.get_all_variables()
+
+        grads = tape.gradient(loss, variables)
+        update = optimizer.apply_gradients(zip(grads, variables))
+
+        if isinstance(model, VarEstimator):
+            with tf.control_dependencies([update]):
+                update = model.apply_masks(optimizer)
+
+        # The update has to run before the step returns in a graph function
+        with tf.control_dependencies([update] if update is not None else []):
+            return tf.contrib.framework.nest.map_structure(tf.identity,
+                                                           (loss, kl_divergence, neg_log_prob, outputs))
+
+    if not compiled:
+        return train_step
+
+    def jit_train_step(inputs, labels, kl_coeff):
+        with tf.contrib.compiler.jit.experimental_jit_scope():
+            return train_step(inputs, labels, kl_coeff)
+
+    def traced_train_step(inputs, labels, kl_coeff):
+        results = (jit_train_step if jit_compile else train_step)(inputs, labels, kl_coeff)
+
+        # The forward pass stores the KLs of the layers as tensors of the
+        # graph function, so they are returned, and restored after the call
+        return results, [tf.identity(layer.kl_divergence) for layer in layers]
+
+    compiled_train_step = tfe.defun(traced_train_step)
+
+    # The first step runs eagerly, so that the optimizer creates its slot
+    # variables outside of the graph function
+    is_first_step = [True]
+
+    def step(inputs, labels, kl_coeff):
+
+        # Tensor arguments, so that the function is only traced again for new
+        # shapes, and not for every new numpy array or kl_coeff value
+        inputs = tf.contrib.framework.nest.map_structure(tf.convert_to_tensor, inputs)
+        labels = tf.convert_to_tensor(labels)
+        kl_coeff = tf.convert_to_tensor(kl_coeff, dtype=tf.float32)
+
+        if is_first_step[0]:
+            is_first_step[0] = False
+
+            return train_step(inputs, labels, kl_coeff)
+
+        results, layer_kls = compiled_train_step(inputs, labels, kl_coeff)
+
+        # Otherwise eager reads of the KL would return symbolic tensors
+        for layer, layer_kl in zip(layers, layer_kls):
+            layer.kl_divergence = layer_kl
+
+        return results
+
+    return step
@@ -2,7 +2,10 @@ import tensorflow as tf
 import pandas as pd
 import numpy as np
 import argparse
-import os, tempfile
+import os, tempfile, shutil
+import time
+import json
+import hashlib
 
 
 def is_valid_file(parser, arg):
@@ -24,7 +27,12 @@ def is_valid_file(parser, arg):
         parser.error("A file at the given path cannot be created: " % arg)
 
 
-def setup_eager_checkpoints_and_restore(variables, checkpoint_dir, checkpoint_name="_ckpt"):
+def setup_eager_checkpoints_and_restore(variables, checkpoint_dir, checkpoint_name="_ckpt", optional_variables=()):
+    """
+    optional_variables may be missing from the checkpoint, e.g. the pruning
+    masks in checkpoints written before they existed. They then keep their
+    initial values.
+    """
     ckpt_prefix = os.path.join(checkpoint_dir, checkpoint_name)
 
     checkpoint = tf.train.Checkpoint(**{v.name: v for v in variables})
@@ -35,12 +43,115 @@ def setup_eager_checkpoints_and_restore(variables, checkpoint_dir, checkpoint_na
         print("No checkpoint found!")
     else:
         print("Checkpoint found at {}, restoring...".format(latest_checkpoint_path))
-        checkpoint.restore(latest_checkpoint_path).assert_consumed()
+
+        try:
+            checkpoint.restore(latest_checkpoint_path).assert_consumed()
+        except AssertionError:
+            if len(optional_variables) == 0:
+                raise
+
+            # Retry with only the required variables, which must all be present
+            optional_names = set([v.name for v in optional_variables])
+
+            required_checkpoint = tf.train.Checkpoint(**{v.name: v for v in variables
+                                                         if v.name not in optional_names})
+            required_checkpoint.restore(latest_checkpoint_path).assert_consumed()
+
+            print("Checkpoint has none of the {} optional variables, "
+                  "they keep their initial values".format(len(optional_names)))
+
         print("Model restored!")
 
     return checkpoint, ckpt_prefix
 
-def load_mushroom_dataset():
+# Preprocessed datasets are cached here by default
+DATASET_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bayes_by_backprop")
+
+# Part of every cache key, increment it whenever the preprocessing code
+# changes, so that stale caches are not loaded
+CACHE_VERSION = 1
+
+
+def cached_arrays(name, params, build_fn, cache_dir=None):
+    """
+    The dict of numpy arrays returned by build_fn(), cached on disk as .npy
+    files in a directory keyed by the name, CACHE_VERSION and a hash of the
+    (JSON serialisable) params that determine the arrays, e.g. the
+    preprocessing parameters and a hash of the source file.
+
+    The cache is written to a temporary directory first and then renamed, so
+    concurrent processes never see a partial cache. Cached arrays are
+    memory-mapped read-only, so they load instantly and processes share
+    their pages.
+    """
+    if cache_dir is None:
+        cache_dir = DATASET_CACHE_DIR
+
+    params = dict(params, cache_version=CACHE_VERSION)
+
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(cache_dir, "{}_{}".format(name, key))
+
+    if not os.path.isdir(path):
+        arrays = build_fn()
+
+        # Arrays of Python objects cannot be memory-mapped, e.g. strings
+        # should be stored with a fixed-width unicode dtype (dtype=str)
+        for array_name, array in arrays.items():
+            if array.dtype == object:
+                raise ValueError("Cannot cache '{}' with dtype object".format(array_name))
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        temp_path = tempfile.mkdtemp(prefix=".{}_".format(name), dir=cache_dir)
+
+        for array_name, array in arrays.items():
+            np.save(os.path.join(temp_path, array_name + ".npy"), array)
+
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Another process has written the same cache in the meantime
+            shutil.rmtree(temp_path)
+
+    return {os.path.splitext(file_name)[0]: np.load(os.path.join(path, file_name), mmap_mode="r")
+            for file_name in os.listdir(path) if file_name.endswith(".npy")}
+
+
+def load_mushroom_dataset(cache_dir=None):
+    """
+    The one-hot encoded mushroom dataset (see parse_mushroom_dataset) as float32,
+    cached by cached_arrays, so the CSV is only parsed once. The cache is
+    keyed by the hash of the CSV, so a changed file is parsed again.
+    """
+    def build():
+        dataset = parse_mushroom_dataset()
+
+        return {"data": dataset.to_numpy().astype(np.float32),
+                "columns": np.array(dataset.columns, dtype=str)}
+
+    with open(mushroom_data_path(), "rb") as f:
+        data_hash = hashlib.sha1(f.read()).hexdigest()
+
+    arrays = cached_arrays("mushroom",
+                           params={"dropped_columns": ["stalk-root"],
+                                   "dtype": "float32",
+                                   "data_hash": data_hash},
+                           build_fn=build,
+                           cache_dir=cache_dir)
+
+    return pd.DataFrame(arrays["data"], columns=arrays["columns"], copy=False)
+
+
+def mushroom_data_path():
+    """
+    Path of the mushroom CSV, which is downloaded on first use
+    """
+    return tf.keras.utils.get_file("agaricus-lepiota.data", "https://archive.ics.uci.edu/ml/machine-learning-databases/mushroom/agaricus-lepiota.data")
+
+
+def parse_mushroom_dataset():
     """
     7. Attribute Information: (classes: edible=e, poisonous=p)
         1. cap-shape:                bell=b,conical=c,convex=x,flat=f,
@@ -78,7 +189,7 @@ def load_mushroom_dataset():
         22. habitat:                  grasses=g,leaves=l,meadows=m,paths=p,
                                     urban=u,waste=w,woods=d
     """
-    data_path = tf.keras.utils.get_file("agaricus-lepiota.data", "https://archive.ics.uci.edu/ml/machine-learning-databases/mushroom/agaricus-lepiota.data")
+    data_path = mushroom_data_path()
 
     column_names = ["class", "cap-shape", "cap-surface", "cap-color",
                     "bruises?", "odor", "gill-attachment", "gill-spacing",
@@ -163,38 +274,144 @@ def generate_new_contexts(dataset,
             eating_rewards.astype(np.float32)), oracle_rewards, oracle_actions, is_edible.to_numpy()
 
 
-def list_slice(tensor, indices, axis):
+def unique_rows(array):
     """
-    Taken from
-    https://stackoverflow.com/questions/46881006/slicing-tensor-with-list-tensorflow
+    Finds the unique rows of a 2D array.
 
-    Args
-    ----
-    tensor (Tensor) : input tensor to slice
-    indices ( [int] ) : list of indices of where to perform slices
-    axis (int) : the axis to perform the slice on
+    Returns the unique rows and the inverse indices, such that
+    unique[inverse] == array
     """
+    array = np.ascontiguousarray(array)
 
-    slices = []   
+    # View every row as a single opaque element, so that np.unique compares
+    # rows as raw bytes instead of lexicographically element by element
+    row_view = array.view(np.dtype((np.void, array.dtype.itemsize * array.shape[1])))
 
-    ## Set the shape of the output tensor. 
-    # Set any unknown dimensions to -1, so that reshape can infer it correctly. 
-    # Set the dimension in the slice direction to be 1, so that overall dimensions are preserved during the operation
-    shape = tensor.get_shape().as_list()
-    shape[shape==None] = -1
-    shape[axis] = 1
+    _, unique_indices, inverse = np.unique(row_view.ravel(),
+                                           return_index=True,
+                                           return_inverse=True)
 
-    nd = len(shape)
+    return array[unique_indices], inverse.ravel()
 
-    for i in indices:   
-        _slice = [slice(None)]*nd
-        _slice[axis] = slice(i,i+1)
-        slices.append(tf.reshape(tensor[_slice], shape))
 
-    return tf.concat(slices, axis=axis)
+class ReplayBuffer(object):
+    """
+    Fixed capacity replay memory for (context, action, reward) tuples.
+
+    The storage is preallocated, once it is full the oldest entries are
+    overwritten. Appending is O(1) per entry, and the contents can be read
+    as views of the storage, without copying.
+    """
+
+    def __init__(self, capacity, context_size):
+
+        self.capacity = capacity
+
+        self._contexts = np.zeros((capacity, context_size), dtype=np.float32)
+        self._actions = np.zeros((capacity,), dtype=np.int32)
+        self._rewards = np.zeros((capacity, 1), dtype=np.float32)
+
+        # Position of the next write and number of valid entries
+        self._next = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, contexts, actions, rewards):
+        """
+        Appends a batch of entries, overwriting the oldest ones if needed
+        """
+        num_entries = len(contexts)
+
+        # Only the newest entries would survive anyway
+        if num_entries > self.capacity:
+            contexts = contexts[-self.capacity:]
+            actions = actions[-self.capacity:]
+            rewards = rewards[-self.capacity:]
+
+            num_entries = self.capacity
+
+        rewards = np.reshape(rewards, (-1, 1))
+
+        # Write up to the end of the storage, then wrap around
+        head = min(num_entries, self.capacity - self._next)
+        tail = num_entries - head
+
+        for storage, data in ((self._contexts, contexts),
+                              (self._actions, actions),
+                              (self._rewards, rewards)):
+            storage[self._next:self._next + head] = data[:head]
+            storage[:tail] = data[head:]
+
+        self._next = (self._next + num_entries) % self.capacity
+        self._size = min(self._size + num_entries, self.capacity)
+
+    @property
+    def contexts(self):
+        return self._contexts[:self._size]
+
+    @property
+    def actions(self):
+        return self._actions[:self._size]
+
+    @property
+    def rewards(self):
+        return self._rewards[:self._size]
+
+    def sample(self, batch_size):
+        """
+        Draws a uniformly random minibatch with replacement, which is O(batch_size)
+        regardless of the size of the buffer. The returned arrays are new copies.
+        """
+        indices = np.random.randint(0, self._size, size=batch_size)
+
+        return (np.take(self._contexts, indices, axis=0),
+                np.take(self._actions, indices, axis=0),
+                np.take(self._rewards, indices, axis=0))
+
+
+def select_features(features, input_indices):
+    """
+    Flattens a batch of examples and keeps only the features in input_indices,
+    e.g. the inputs a compressed model still uses. This is a single gather, so
+    it can be mapped over a batched tf.data pipeline or applied once to a
+    whole dataset.
+    """
+    features = tf.convert_to_tensor(features)
+    features = tf.reshape(features, [tf.shape(features)[0], -1])
+
+    return tf.gather(features, tf.convert_to_tensor(input_indices, dtype=tf.int32), axis=1)
+
+def dataset_throughput(dataset, num_batches=None):
+    """
+    Examples per second produced by a batched dataset on its own, over
+    num_batches batches (or a full pass), after a warm-up batch
+    """
+    iterator = iter(dataset)
+
+    # Warm-up, e.g. filling the shuffle buffer
+    next(iterator)
+
+    num_examples = 0
+    start = time.time()
+
+    for i, (features, _) in enumerate(iterator):
+        if num_batches is not None and i >= num_batches:
+            break
+
+        num_examples += int(features.shape[0])
+
+    return num_examples / (time.time() - start)
+
 
 if __name__ == "__main__":
     ds = load_mushroom_dataset()
+
+    # The second call must load the memory-mapped cache
+    cached_ds = load_mushroom_dataset()
+    assert np.array_equal(ds.to_numpy(), cached_ds.to_numpy())
+    assert list(ds.columns) == list(cached_ds.columns)
     stuff = generate_new_contexts(ds, 10)
     (ctx, ner, er), ore, ora = stuff
 
@@ -3,8 +3,7 @@ import tensorflow as tf
 import tensorflow_probability as tfp
 import sonnet as snt
 
-from compression import eliminate_dead_neurons
-from utils import list_slice
+from compression import eliminate_dead_neurons, neuron_snr
 
 class VarEstimator(snt.AbstractModule):
     """
@@ -14,6 +13,7 @@ class VarEstimator(snt.AbstractModule):
 
     def __init__(self,
                  prior,
+                 estimator="weight",
                  name="var_estimator"):
 
         # Call to super
@@ -21,6 +21,7 @@ class VarEstimator(snt.AbstractModule):
 
         # Private fields
         self._layers = []
+        self._estimator = estimator
         self.is_training = True
 
         # Public fields
@@ -33,9 +34,27 @@ class VarEstimator(snt.AbstractModule):
 
     @property
     def kl_divergence(self):
+        """
+        KL-divergence estimate of the last forward pass. If it used
+        num_samples > 1, this is averaged over the samples.
+        """
         self._ensure_is_connected()
         return sum([layer.kl_divergence for layer in self._layers])
 
+    @property
+    def layers(self):
+        self._ensure_is_connected()
+        return self._layers
+
+    @property
+    def mask_variables(self):
+        """
+        The pruning masks of the layers. Older checkpoints do not have them,
+        see utils.setup_eager_checkpoints_and_restore.
+        """
+        self._ensure_is_connected()
+        return [mask for layer in self._layers for mask in (layer.w_mask, layer.b_mask)]
+
     @property
     def mu_vector(self):
         self._ensure_is_connected()
@@ -50,34 +69,150 @@ class VarEstimator(snt.AbstractModule):
                          [tf.reshape(layer.b_sigma, [-1]) for layer in self._layers],
                          axis=0)
 
+    @property
+    def num_params(self):
+        """
+        Number of weights and biases, including the pruned ones
+        """
+        self._ensure_is_connected()
+        return sum([layer.w_mu.shape.num_elements() + layer.b_mu.shape.num_elements()
+                    for layer in self._layers])
+
+    @property
+    def num_unpruned_params(self):
+        """
+        Number of weights and biases that survived pruning
+        """
+        self._ensure_is_connected()
+        return int(sum([tf.reduce_sum(layer.w_mask) + tf.reduce_sum(layer.b_mask)
+                        for layer in self._layers]))
+
+    def snrs(self):
+        """
+        Generator of the SNRs of each layer's weights and biases as flat numpy
+        arrays, with -inf for pruned parameters. Compared to snr(mu_vector,
+        sigma_vector), this never builds the vectors of the whole model.
+        """
+        self._ensure_is_connected()
+
+        for layer in self._layers:
+            for snrs in layer.get_snr():
+                if snrs is None:
+                    continue
+
+                snrs = snrs.numpy().reshape(-1)
+                snrs[np.isnan(snrs)] = -np.inf
+
+                yield snrs
+
     def prune_below_snr(self, snr, verbose=False):
         self._ensure_is_connected()
 
         for layer in self._layers:
             layer.prune_below_snr(snr, verbose)
 
+    def apply_masks(self, optimizer=None):
+        """
+        Re-zeroes the pruned parameters of every layer and their optimizer
+        slots, see VarLinear.apply_masks
+        """
+        self._ensure_is_connected()
+
+        return tf.group(*[layer.apply_masks(optimizer) for layer in self._layers])
+
+    def neuron_snrs(self):
+        """
+        Generator of the aggregated SNRs (compression.neuron_snr) of the
+        hidden neurons of each layer
+        """
+        self._ensure_is_connected()
+
+        for layer, next_layer in zip(self._layers[:-1], self._layers[1:]):
+            w_mu_in, w_sigma_in, _, _ = layer.get_posterior_params()
+            w_mu_out, w_sigma_out, _, _ = next_layer.get_posterior_params()
+
+            yield neuron_snr(w_mu_in, w_sigma_in, w_mu_out, w_sigma_out)
+
+    def prune_neurons_below_snr(self, snr, verbose=False):
+        """
+        Structured pruning: removes every hidden neuron whose aggregated SNR is
+        not above snr, by pruning all of its incoming weights. compress then
+        absorbs its constant output into the next layer and removes it, which
+        leaves smaller dense layers.
+        """
+        self._ensure_is_connected()
+
+        for layer, snrs in zip(self._layers[:-1], list(self.neuron_snrs())):
+            layer.prune_units(snrs > snr, verbose)
+
     def sample_posterior(self):
         return tfp.distributions.Normal(loc=self.mu_vector, scale=self.sigma_vector).sample()
 
-    def compress(self):
-        input_indices, w_mus, w_sigmas, b_mus, b_sigmas = \
-            eliminate_dead_neurons(w_mus=[layer.w_mu.numpy() for layer in self._layers],
-                               w_sigmas=[layer.w_sigma.numpy() for layer in self._layers],
-                               b_mus=[layer.b_mu.numpy() for layer in self._layers],
-                               b_sigmas=[layer.b_sigma.numpy() for layer in self._layers],
-                               activations=[tf.nn.relu, tf.nn.relu, lambda x: x])
-
-        reduced_model = ReducedVarMNIST(prior=self.prior,
-                                        w_mus=w_mus,
-                                        w_sigmas=w_sigmas,
-                                        b_mus=b_mus,
-                                        b_sigmas=b_sigmas,
-                                        input_indices=input_indices)
-
-        #print([w_mu.shape for w_mu in w_mus])
-        #print([b_mu.shape for b_mu in b_mus])
-        return reduced_model
+    @property
+    def input_size(self):
+        self._ensure_is_connected()
+        return self._layers[0].input_size
+
+    @property
+    def original_input_size(self):
+        """
+        Input size of the uncompressed model
+        """
+        return self.input_size
+
+    def original_input_indices(self, input_indices):
+        """
+        Maps indices of the first layer's inputs to indices of the original
+        model's inputs
+        """
+        return input_indices
+
+    @property
+    def activations(self):
+        """
+        Activations applied after each layer: every architecture here is a
+        ReLU network with a linear output layer
+        """
+        self._ensure_is_connected()
+        return [tf.nn.relu] * (len(self._layers) - 1) + [tf.identity]
+
+    def compress(self, verbose=False):
+        """
+        Creates a smaller ReducedVarEstimator with the same predictions, by
+        removing the pruned neurons and input features. The reduced model is
+        connected and initialised to the pruned posterior.
+        """
+        self._ensure_is_connected()
 
+        w_mus, w_sigmas, b_mus, b_sigmas = zip(*[layer.get_posterior_params()
+                                                 for layer in self._layers])
+
+        input_indices, w_mus, w_sigmas, b_mus, b_sigmas, report = \
+            eliminate_dead_neurons(w_mus=w_mus,
+                                   w_sigmas=w_sigmas,
+                                   b_mus=b_mus,
+                                   b_sigmas=b_sigmas,
+                                   activations=self.activations)
+
+        if verbose:
+            print(report)
+
+        reduced_model = ReducedVarEstimator(prior=self.prior,
+                                            w_mus=w_mus,
+                                            w_sigmas=w_sigmas,
+                                            b_mus=b_mus,
+                                            b_sigmas=b_sigmas,
+                                            activations=self.activations,
+                                            negative_log_likelihood=self.negative_log_likelihood,
+                                            input_indices=self.original_input_indices(input_indices),
+                                            original_input_size=self.original_input_size,
+                                            estimator=self._estimator,
+                                            name="reduced_" + self.module_name)
+
+        # Connect it, which creates the variables with the pruned parameters
+        reduced_model(tf.zeros((1, reduced_model.input_size)))
+
+        return reduced_model
 
 
 class VarMushroomRL(VarEstimator):
@@ -87,17 +222,20 @@ class VarMushroomRL(VarEstimator):
     def __init__(self,
                  units,
                  prior,
+                 estimator="weight",
                  name="var_mushroom_rl"):
 
         super(VarMushroomRL, self).__init__(prior=prior,
+                                            estimator=estimator,
                                             name=name)
 
         self.units = units
+        self.output_size = 1
 
     def negative_log_likelihood(self, predictions, labels, sigma=1.):
         return neg_log_prob_with_gaussian(predictions, labels, sigma)
 
-    def _build(self, inputs):
+    def _build(self, inputs, num_samples=1):
 
         # Flatten input
         flatten = snt.BatchFlatten()
@@ -105,23 +243,83 @@ class VarMushroomRL(VarEstimator):
 
         # First linear layer
         linear_1 = VarLinear(output_size=self.units,
-                             prior=self.prior)
+                             prior=self.prior,
+                             estimator=self._estimator)
 
-        dense = linear_1(flattened)
+        dense = linear_1(flattened, num_samples=num_samples)
         dense = tf.nn.relu(dense)
 
         # Second linear layer
         linear_2 = VarLinear(output_size=self.units,
-                             prior=self.prior)
+                             prior=self.prior,
+                             estimator=self._estimator)
 
-        dense = linear_2(dense)
+        dense = linear_2(dense, num_samples=num_samples)
         dense = tf.nn.relu(dense)
 
         # Final linear layer
-        linear_out = VarLinear(output_size=1,
-                               prior=self.prior)
+        linear_out = VarLinear(output_size=self.output_size,
+                               prior=self.prior,
+                               estimator=self._estimator)
+
+        logits = linear_out(dense, num_samples=num_samples)
+
+        self._layers = [linear_1, linear_2, linear_out]
+
+        return logits
+
+
+class VarMushroomMultiHeadRL(VarEstimator):
+    """
+    Q-function estimator that takes only the context and predicts the expected
+    reward of every action at once, so all actions share a weight sample
+    """
+    def __init__(self,
+                 units,
+                 prior,
+                 num_actions=2,
+                 estimator="weight",
+                 name="var_mushroom_multi_head_rl"):
+
+        super(VarMushroomMultiHeadRL, self).__init__(prior=prior,
+                                                     estimator=estimator,
+                                                     name=name)
+
+        self.units = units
+        self.num_actions = num_actions
+        self.output_size = num_actions
+
+    def negative_log_likelihood(self, predictions, labels, sigma=1.):
+        return neg_log_prob_with_gaussian(predictions, labels, sigma)
+
+    def _build(self, inputs, num_samples=1):
+
+        # Flatten input
+        flatten = snt.BatchFlatten()
+        flattened = flatten(inputs)
 
-        logits = linear_out(dense)
+        # First linear layer
+        linear_1 = VarLinear(output_size=self.units,
+                             prior=self.prior,
+                             estimator=self._estimator)
+
+        dense = linear_1(flattened, num_samples=num_samples)
+        dense = tf.nn.relu(dense)
+
+        # Second linear layer
+        linear_2 = VarLinear(output_size=self.units,
+                             prior=self.prior,
+                             estimator=self._estimator)
+
+        dense = linear_2(dense, num_samples=num_samples)
+        dense = tf.nn.relu(dense)
+
+        # Final linear layer, one head per action
+        linear_out = VarLinear(output_size=self.output_size,
+                               prior=self.prior,
+                               estimator=self._estimator)
+
+        logits = linear_out(dense, num_samples=num_samples)
 
         self._layers = [linear_1, linear_2, linear_out]
 
@@ -136,18 +334,21 @@ class VarRegression(VarEstimator):
     def __init__(self,
                  units,
                  prior,
+                 estimator="weight",
                  name="var_regression"):
 
         super(VarRegression, self).__init__(prior=prior,
+                                            estimator=estimator,
                                             name=name)
 
         self.units = units
+        self.output_size = 1
 
     def negative_log_likelihood(self, predictions, labels, sigma=1.):
         return neg_log_prob_with_gaussian(predictions, labels, sigma)
 
 
-    def _build(self, inputs):
+    def _build(self, inputs, num_samples=1):
 
         # Flatten input
         flatten = snt.BatchFlatten()
@@ -155,23 +356,26 @@ class VarRegression(VarEstimator):
 
         # First linear layer
         linear_1 = VarLinear(output_size=self.units,
-                             prior=self.prior)
+                             prior=self.prior,
+                             estimator=self._estimator)
 
-        dense = linear_1(flattened)
+        dense = linear_1(flattened, num_samples=num_samples)
         dense = tf.nn.relu(dense)
 
         # Second linear layer
         linear_2 = VarLinear(output_size=self.units,
-                             prior=self.prior)
+                             prior=self.prior,
+                             estimator=self._estimator)
 
-        dense = linear_2(dense)
+        dense = linear_2(dense, num_samples=num_samples)
         dense = tf.nn.relu(dense)
 
         # Final linear layer
-        linear_out = VarLinear(output_size=1,
-                               prior=self.prior)
+        linear_out = VarLinear(output_size=self.output_size,
+                               prior=self.prior,
+                               estimator=self._estimator)
 
-        logits = linear_out(dense)
+        logits = linear_out(dense, num_samples=num_samples)
 
         self._layers = [linear_1, linear_2, linear_out]
 
@@ -185,18 +389,21 @@ class VarMNIST(VarEstimator):
     def __init__(self,
                  units,
                  prior,
+                 estimator="weight",
                  name="var_mnist",
                  **kwargs):
 
         super(VarMNIST, self).__init__(prior=prior,
+                                       estimator=estimator,
                                        name=name)
 
         self.units = units
+        self.output_size = 10
 
     def negative_log_likelihood(self, logits, labels):
         return neg_log_prob_with_categorical(logits, labels)
 
-    def _build(self, inputs):
+    def _build(self, inputs, num_samples=1):
 
         # Flatten input
         flatten = snt.BatchFlatten()
@@ -204,133 +411,200 @@ class VarMNIST(VarEstimator):
 
         # First linear layer
         linear_1 = VarLinear(output_size=self.units,
-                             prior=self.prior)
+                             prior=self.prior,
+                             estimator=self._estimator)
 
-        dense = linear_1(flattened)
+        dense = linear_1(flattened, num_samples=num_samples)
         dense = tf.nn.relu(dense)
 
         # Second linear layer
         linear_2 = VarLinear(output_size=self.units,
-                             prior=self.prior)
+                             prior=self.prior,
+                             estimator=self._estimator)
 
-        dense = linear_2(dense)
+        dense = linear_2(dense, num_samples=num_samples)
         dense = tf.nn.relu(dense)
 
         # Final linear layer
-        linear_out = VarLinear(output_size=10,
-                               prior=self.prior)
+        linear_out = VarLinear(output_size=self.output_size,
+                               prior=self.prior,
+                               estimator=self._estimator)
 
-        logits = linear_out(dense)
+        logits = linear_out(dense, num_samples=num_samples)
 
         self._layers = [linear_1, linear_2, linear_out]
 
         return logits
 
 
-class ReducedVarMNIST(VarEstimator):
+class ReducedVarEstimator(VarEstimator):
+    """
+    ReLU network whose variational layers are initialised from the given
+    (pruned) posterior parameters, see VarEstimator.compress.
+
+    The model only takes the input features in input_indices (out of the
+    original_input_size inputs of the original model), which should be
+    selected in the input pipeline, e.g. with utils.select_features.
+    """
     def __init__(self,
-                 input_indices,
                  w_mus,
                  w_sigmas,
                  b_mus,
                  b_sigmas,
+                 activations,
+                 negative_log_likelihood,
                  prior,
-                 name="reduced_var_mnist",
-                 **kwargs):
+                 input_indices=None,
+                 original_input_size=None,
+                 estimator="weight",
+                 name="reduced_var_estimator"):
 
-        super(ReducedVarMNIST, self).__init__(prior=prior,
-                                              name=name)
+        super(ReducedVarEstimator, self).__init__(prior=prior,
+                                                  estimator=estimator,
+                                                  name=name)
 
         self._w_mus = w_mus
         self._w_sigmas = w_sigmas
         self._b_mus = b_mus
         self._b_sigmas = b_sigmas
+        self._activations = activations
+        self._negative_log_likelihood = negative_log_likelihood
         self._input_indices = input_indices
+        self._original_input_size = original_input_size
 
+        self.output_size = w_mus[-1].shape[1]
 
-    def get_unused_input_mask(self):
-        mask = np.zeros((28 * 28,), dtype=np.float32)
-
-        mask[self._input_indices] = 1
+    def negative_log_likelihood(self, *args, **kwargs):
+        return self._negative_log_likelihood(*args, **kwargs)
 
-        return mask.reshape((28, 28))
-
-
-    def assign_params(self):
-
-        for i, layer in enumerate(self._layers):
-
-            tf.assign(layer.w_mu, tf.convert_to_tensor(self._w_mus[i]))
-            tf.assign(layer.b_mu, tf.convert_to_tensor(self._b_mus[i]))
+    @property
+    def input_size(self):
+        return self._w_mus[0].shape[0]
 
-            tf.assign(layer.w_rho, tf.contrib.distributions.softplus_inverse(
-                tf.convert_to_tensor(self._w_sigmas[i])))
-            tf.assign(layer.b_rho, tf.contrib.distributions.softplus_inverse(
-                tf.convert_to_tensor(self._b_sigmas[i])))
+    @property
+    def original_input_size(self):
+        return self._original_input_size
 
+    @property
+    def input_indices(self):
+        return self._input_indices
 
-    def _build(self, inputs):
+    def original_input_indices(self, input_indices):
+        if self._input_indices is None:
+            return input_indices
 
-        num_units = [w.shape[1] for w in self._w_mus]
-        #print("Units: {}".format(num_units))
+        return list(np.asarray(self._input_indices)[input_indices])
 
-        # Flatten input
+    @property
+    def activations(self):
+        return self._activations
+
+    def get_unused_input_mask(self, shape=None):
+        """
+        1 for the input features the reduced model uses, 0 for the eliminated
+        ones, e.g. shape=(28, 28) for MNIST
+        """
+        if self._input_indices is None:
+            # No input feature was eliminated
+            mask = np.ones((self.input_size,), dtype=np.float32)
+        else:
+            mask = np.zeros((self.original_input_size,), dtype=np.float32)
+            mask[self._input_indices] = 1
+
+        return mask if shape is None else mask.reshape(shape)
+
+    @staticmethod
+    def _initializers(w_mu, w_sigma, b_mu, b_sigma):
+        """
+        Initializers of a VarLinear that recreate the given posterior.
+        Pruned parameters have 0 variance, they stay masked.
+        """
+        initializers = {}
+
+        for name, mu, sigma in (("w", w_mu, w_sigma), ("b", b_mu, b_sigma)):
+            mask = (sigma > 0).astype(np.float32)
+            rho = np.log(np.expm1(np.where(mask > 0, sigma, 1.)))
+
+            initializers[name + "_mu"] = tf.constant_initializer(mu)
+            initializers[name + "_rho"] = tf.constant_initializer(rho)
+            initializers[name + "_mask"] = tf.constant_initializer(mask)
+
+        return initializers
+
+    def _build(self, inputs, num_samples=1):
+
+        # Flatten input, the unused features are already removed
         flatten = snt.BatchFlatten()
-        flattened = flatten(inputs)
-
-        # Only retain the ones we didn't throw out
-        flattened = list_slice(flattened, self._input_indices, axis=1)
-
-        # First linear layer
-        linear_1 = VarLinear(output_size=num_units[0],
-                             prior=self.prior)
-
-        dense = linear_1(flattened)
-        dense = tf.nn.relu(dense)
+        outputs = flatten(inputs)
 
-        # Second linear layer
-        linear_2 = VarLinear(output_size=num_units[1],
-                             prior=self.prior)
+        self._layers = []
 
-        dense = linear_2(dense)
-        dense = tf.nn.relu(dense)
+        for i, activation in enumerate(self._activations):
+            linear = VarLinear(output_size=self._w_mus[i].shape[1],
+                               prior=self.prior,
+                               estimator=self._estimator,
+                               initializers=self._initializers(self._w_mus[i],
+                                                               self._w_sigmas[i],
+                                                               self._b_mus[i],
+                                                               self._b_sigmas[i]))
 
-        # Final linear layer
-        linear_out = VarLinear(output_size=10,
-                               prior=self.prior)
+            outputs = activation(linear(outputs, num_samples=num_samples))
 
-        logits = linear_out(dense)
+            self._layers.append(linear)
 
-        self._layers = [linear_1, linear_2, linear_out]
-
-        return logits
+        return outputs
 
 
 class VarLinear(snt.AbstractModule):
     """
     Variational fully-connected layer
+
+    The estimator determines how the stochastic forward pass is computed:
+     - "weight": a single weight matrix is sampled and shared by the minibatch
+     - "local_reparam": the pre-activations are sampled directly from their
+       Gaussian marginals (Kingma et al., 2015), so no weight matrix is needed
+       for the forward pass
+     - "flipout": every example gets its own pseudo-independent weight
+       perturbation by flipping the signs of a shared one (Wen et al., 2018)
     """
 
+    ESTIMATORS = ("weight", "local_reparam", "flipout")
+
+    POSSIBLE_INITIALIZER_KEYS = {"w_mu", "w_rho", "w_mask", "b_mu", "b_rho", "b_mask"}
+
     def __init__(self,
                  output_size,
                  prior,
                  use_bias=True,
+                 estimator="weight",
+                 initializers=None,
                  name="var_linear"):
 
         # Initialise the underlying linear module
         super(VarLinear, self).__init__(name=name)
 
+        if estimator not in self.ESTIMATORS:
+            raise ValueError("Unknown estimator '{}', must be one of {}".format(
+                estimator, self.ESTIMATORS))
+
         self._input_shape = None
         self._use_bias = use_bias
+        self._estimator = estimator
+        self._initializers = snt.check_initializers(initializers, self.POSSIBLE_INITIALIZER_KEYS)
 
         self.output_size = output_size
         self.prior = prior
 
 
     def prune_below_snr(self, snr, verbose=False):
+        """
+        Prunes the weights (and biases) whose SNR is not above snr, by updating
+        the pruning masks. Weights that are already pruned stay pruned.
+        """
         self._ensure_is_connected()
 
-        w_snr = 10. * tf.math.log(tf.abs(self._w_mu) / self.w_sigma)
+        # Pruned weights have 0 / 0 SNR, which is not greater than anything
+        w_snr, b_snr = self.get_snr()
         w_mask = tf.cast(tf.math.greater(w_snr, snr), dtype=tf.float32)
 
         if verbose:
@@ -342,12 +616,10 @@ class VarLinear(snt.AbstractModule):
                 100 * num_pruned / self._num_weights,
                 self.module_name))
 
+        self._w_mask.assign(w_mask)
         self._w_mu.assign(self._w_mu * w_mask)
-        self._w_rho.assign(tf.contrib.distributions.softplus_inverse(
-            self.w_sigma * w_mask))
 
         if self._use_bias:
-            b_snr = 10. * tf.math.log(tf.abs(self._b_mu) / self.b_sigma)
             b_mask = tf.cast(tf.math.greater(b_snr, snr), dtype=tf.float32)
 
             if verbose:
@@ -359,40 +631,161 @@ class VarLinear(snt.AbstractModule):
                     100 * num_pruned / self._num_biases,
                     self.module_name))
 
+            self._b_mask.assign(b_mask)
             self._b_mu.assign(self._b_mu * b_mask)
-            self._b_rho.assign(tf.contrib.distributions.softplus_inverse(
-                self.b_sigma * b_mask))
 
-    def _build(self, inputs):
+    def apply_masks(self, optimizer=None):
+        """
+        Re-zeroes the pruned entries of the means, and of the optimizer's slots
+        of the means and rhos. Pruned parameters get no gradients, but
+        optimizers with momentum (e.g. Adam) would keep moving them.
+        """
+        self._ensure_is_connected()
+
+        masked = [(self._w_mu, self._w_mask), (self._w_rho, self._w_mask)]
+
+        if self._use_bias:
+            masked += [(self._b_mu, self._b_mask), (self._b_rho, self._b_mask)]
+
+        updates = [self._w_mu.assign(self._w_mu * self._w_mask)]
+
+        if self._use_bias:
+            updates.append(self._b_mu.assign(self._b_mu * self._b_mask))
+
+        if optimizer is not None:
+            for variable, mask in masked:
+                for slot_name in optimizer.get_slot_names():
+                    slot = optimizer.get_slot(variable, slot_name)
+
+                    if slot is not None:
+                        updates.append(slot.assign(slot * mask))
+
+        return tf.group(*updates)
+
+    def prune_units(self, keep, verbose=False):
+        """
+        Prunes all incoming weights of the output units where keep is False.
+        The biases are kept, so the pruned units output a constant.
+        """
+        self._ensure_is_connected()
+
+        unit_mask = tf.cast(tf.convert_to_tensor(keep), dtype=tf.float32)
+
+        if verbose:
+            num_pruned = tf.reduce_sum(1. - unit_mask)
+
+            print("Pruning {} out of {} units ({:.2f}%) on {}".format(
+                int(num_pruned),
+                self.output_size,
+                100 * num_pruned / self.output_size,
+                self.module_name))
+
+        w_mask = self._w_mask * unit_mask
+
+        self._w_mask.assign(w_mask)
+        self._w_mu.assign(self._w_mu * w_mask)
+
+    def get_snr(self):
+        """
+        SNR of the weights and biases in decibels, computed the same way as
+        compression.snr. Pruned entries have SNR NaN (0 / 0).
+        """
+        self._ensure_is_connected()
+
+        def decibels(mu, sigma):
+            return 10. * tf.math.log(tf.abs(mu) / sigma) / np.log(10.)
+
+        w_snr = decibels(self.w_mu, self.w_sigma)
+        b_snr = decibels(self.b_mu, self.b_sigma) if self._use_bias else None
+
+        return w_snr, b_snr
+
+    @staticmethod
+    def _unmasked_posterior(mu, rho, mask):
+        """
+        The indices of the unpruned entries of the flattened parameter, and
+        the posterior over only those entries
+        """
+        indices = tf.where(tf.reshape(mask, [-1]) > 0.)
+
+        dist = tfp.distributions.Normal(loc=tf.gather_nd(tf.reshape(mu, [-1]), indices),
+                                        scale=tf.nn.softplus(tf.gather_nd(tf.reshape(rho, [-1]), indices)))
+
+        return indices, dist
+
+    def _kl_divergence_term(self, dist, sample=None, num_samples=1):
+        """
+        KL(q || p) summed over the entries of the posterior dist. If the prior
+        is Gaussian, the closed form is used, otherwise we use a Monte Carlo
+        estimate averaged over the num_samples samples stacked in sample.
+        """
+
+        if self.analytic_kl:
+            return tf.reduce_sum(tfp.distributions.kl_divergence(dist, self.prior))
+
+        kl = tf.reduce_sum(dist.log_prob(sample)) - reduce_log_prob(self.prior, sample)
+
+        return kl / num_samples
+
+    def _build(self, inputs, num_samples=1):
+        """
+        If num_samples > 1, num_samples independent forward passes are stacked
+        along a new leading dimension, i.e. for inputs of shape
+        [batch_size, input_size] or [num_samples, batch_size, input_size] the
+        output has shape [num_samples, batch_size, output_size].
+        """
 
         # ======================================================================
         # Ensure the input has the correct size
         # ======================================================================
         input_shape = tuple(inputs.get_shape().as_list())
 
-        if len(input_shape) != 2:
-            raise base.IncompatibleShapeError(
+        if num_samples == 1 and len(input_shape) != 2:
+            raise snt.IncompatibleShapeError(
                 "{}: rank of shape must be 2 not: {}".format(
                     self.scope_name, len(input_shape)))
 
-        if input_shape[1] is None:
-            raise base.IncompatibleShapeError(
+        if num_samples > 1 and len(input_shape) not in (2, 3):
+            raise snt.IncompatibleShapeError(
+                "{}: rank of shape must be 2 or 3 not: {}".format(
+                    self.scope_name, len(input_shape)))
+
+        if len(input_shape) == 3 and input_shape[0] != num_samples:
+            raise snt.IncompatibleShapeError(
+                "{}: Input shape must be [{}, batch_size, input_size] not: [{}, batch_size, input_size]"
+                .format(self.scope_name, num_samples, input_shape[0]))
+
+        if input_shape[-1] is None:
+            raise snt.IncompatibleShapeError(
                 "{}: Input size must be specified at module build time".format(
                     self.scope_name))
 
-        if self._input_shape is not None and input_shape[1] != self._input_shape[1]:
-            raise base.IncompatibleShapeError(
+        if self._input_shape is not None and input_shape[-1] != self._input_shape[1]:
+            raise snt.IncompatibleShapeError(
                 "{}: Input shape must be [batch_size, {}] not: [batch_size, {}]"
-                .format(self.scope_name, self._input_shape[1], input_shape[1]))
+                .format(self.scope_name, self._input_shape[1], input_shape[-1]))
+
+        # Stack the inputs for every sample
+        if num_samples > 1 and len(input_shape) == 2:
+            inputs = tf.tile(tf.expand_dims(inputs, 0), [num_samples, 1, 1])
+
+        sample_shape = () if num_samples == 1 else (num_samples,)
 
         # ======================================================================
         # Initialise parameters
         # ======================================================================
-        self._input_shape = input_shape
+        self._input_shape = (None, input_shape[-1])
         dtype = inputs.dtype
 
-        mu_init = tf.initializers.glorot_uniform()
-        rho_init = tf.initializers.constant(-3)
+        initializers = {
+            "w_mu": tf.initializers.glorot_uniform(),
+            "w_rho": tf.initializers.constant(-3),
+            "w_mask": tf.initializers.ones(),
+            "b_mu": tf.initializers.glorot_uniform(),
+            "b_rho": tf.initializers.constant(-3),
+            "b_mask": tf.initializers.ones(),
+        }
+        initializers.update(self._initializers)
 
         weight_shape = (self._input_shape[1], self.output_size)
 
@@ -402,22 +795,69 @@ class VarLinear(snt.AbstractModule):
         self._w_mu = tf.get_variable("w_mu",
                                      shape=weight_shape,
                                      dtype=dtype,
-                                     initializer=mu_init)
+                                     initializer=initializers["w_mu"])
         self._w_rho = tf.get_variable("w_rho",
                                       shape=weight_shape,
                                       dtype=dtype,
-                                      initializer=rho_init)
+                                      initializer=initializers["w_rho"])
+
+        # Pruning mask: pruned weights are exactly 0, and they are excluded
+        # from the KL and get no gradients
+        self._w_mask = tf.get_variable("w_mask",
+                                       shape=weight_shape,
+                                       dtype=dtype,
+                                       initializer=initializers["w_mask"],
+                                       trainable=False)
+
+        # Only the unpruned weights are sampled, and only their log-densities
+        # are evaluated. The samples are scattered into a dense matrix for the
+        # matmul, in which the pruned weights are exactly 0.
+        w_indices, w_dist = self._unmasked_posterior(self._w_mu, self._w_rho, self._w_mask)
+
+        # Masked posterior parameters, the module is not connected yet, so the
+        # properties cannot be used here
+        w_mu = self._w_mu * self._w_mask
+        w_sigma = tf.nn.softplus(self._w_rho) * self._w_mask
+
+        # The local reparameterization only needs a weight sample for the
+        # Monte Carlo estimate of the KL
+        if self._estimator != "local_reparam" or not self.analytic_kl:
+            # [num_unpruned] or [num_samples, num_unpruned]
+            w_values = w_dist.sample(sample_shape)
+        else:
+            w_values = None
+
+        # Calculate KL-divergence for later
+        self._kl_divergence = self._kl_divergence_term(w_dist, w_values, num_samples)
 
-        w_dist = tfp.distributions.Normal(loc=self._w_mu,
-                                          scale=tf.nn.softplus(self._w_rho))
+        if self._estimator == "local_reparam":
+            # a ~ N(x'mu, (x^2)'sigma^2), the marginal of a = x'W
+            a_mu = batch_matmul(inputs, w_mu)
+            a_var = batch_matmul(tf.square(inputs), tf.square(w_sigma))
 
-        w = w_dist.sample()
+            eps = tf.random_normal(tf.shape(a_mu), dtype=dtype)
 
-        # Calculate KL-divergence for later
-        self._kl_divergence = tf.reduce_sum(w_dist.log_prob(w) - self.prior.log_prob(w))
+            # The small constant keeps the gradient of the sqrt finite for
+            # all-zero inputs (e.g. dead ReLUs)
+            outputs = a_mu + tf.sqrt(a_var + 1e-16) * eps
+        elif self._estimator == "flipout":
+            # W_n = mu + (W - mu) o r_n s_n', where r_n and s_n are random sign
+            # vectors of example n, so a_n = x_n'mu + ((x_n o s_n)'(W - mu)) o r_n
+            batch_shape = tf.shape(inputs)[:-1]
 
-        # a = x'W, where W ~ q(W | mu, theta)
-        outputs = tf.matmul(inputs, w)
+            sign_in = random_sign(tf.shape(inputs), dtype=dtype)
+            sign_out = random_sign(tf.concat([batch_shape, [self.output_size]], axis=0),
+                                   dtype=dtype)
+
+            w_perturbation = scatter_unmasked(w_indices, w_values - w_dist.loc, weight_shape, sample_shape)
+
+            outputs = batch_matmul(inputs, w_mu) + \
+                      batch_matmul(inputs * sign_in, w_perturbation) * sign_out
+        else:
+            # a = x'W, where W ~ q(W | mu, theta)
+            w = scatter_unmasked(w_indices, w_values, weight_shape, sample_shape)
+
+            outputs = batch_matmul(inputs, w)
 
         if self._use_bias:
             bias_shape = (self.output_size,)
@@ -427,18 +867,27 @@ class VarLinear(snt.AbstractModule):
             self._b_mu = tf.get_variable("b_mu",
                                          shape=bias_shape,
                                          dtype=dtype,
-                                         initializer=mu_init)
+                                         initializer=initializers["b_mu"])
             self._b_rho = tf.get_variable("b_rho",
                                           shape=bias_shape,
                                           dtype=dtype,
-                                          initializer=rho_init)
+                                          initializer=initializers["b_rho"])
+            self._b_mask = tf.get_variable("b_mask",
+                                           shape=bias_shape,
+                                           dtype=dtype,
+                                           initializer=initializers["b_mask"],
+                                           trainable=False)
+
+            b_indices, b_dist = self._unmasked_posterior(self._b_mu, self._b_rho, self._b_mask)
 
-            b_dist = tfp.distributions.Normal(loc=self._b_mu,
-                                              scale=tf.nn.softplus(self._b_rho))
+            b_values = b_dist.sample(sample_shape)
+            self._kl_divergence += self._kl_divergence_term(b_dist, b_values, num_samples)
 
-            b = b_dist.sample()
-            self._kl_divergence += tf.reduce_sum(b_dist.log_prob(b) - self.prior.log_prob(b))
+            b = scatter_unmasked(b_indices, b_values, bias_shape, sample_shape)
 
+            # Broadcast every bias sample over the batch
+            if num_samples > 1:
+                b = tf.expand_dims(b, 1)
 
             # a = x'W, where W ~ q(W | mu, theta), b ~ q(b | mu, theta)
             outputs += b
@@ -446,15 +895,33 @@ class VarLinear(snt.AbstractModule):
         return outputs
 
 
+    @property
+    def input_size(self):
+        self._ensure_is_connected()
+        return self._input_shape[1]
+
     @property
     def kl_divergence(self):
         self._ensure_is_connected()
         return self._kl_divergence
 
+    @kl_divergence.setter
+    def kl_divergence(self, value):
+        # Used to replace the KL stored by a forward pass inside a graph
+        # function with its value, see training.create_train_step
+        self._kl_divergence = value
+
+    @property
+    def analytic_kl(self):
+        return isinstance(self.prior, tfp.distributions.Normal)
+
     @property
     def w_mu(self):
+        """
+        Posterior means, which are 0 for pruned weights
+        """
         self._ensure_is_connected()
-        return self._w_mu
+        return self._w_mu * self._w_mask
 
     @property
     def w_rho(self):
@@ -463,13 +930,24 @@ class VarLinear(snt.AbstractModule):
 
     @property
     def w_sigma(self):
+        """
+        Posterior standard deviations, which are 0 for pruned weights
+        """
         self._ensure_is_connected()
-        return tf.nn.softplus(self._w_rho)
+        return tf.nn.softplus(self._w_rho) * self._w_mask
+
+    @property
+    def w_mask(self):
+        self._ensure_is_connected()
+        return self._w_mask
 
     @property
     def b_mu(self):
+        """
+        Posterior means, which are 0 for pruned biases
+        """
         self._ensure_is_connected()
-        return self._b_mu
+        return self._b_mu * self._b_mask
 
     @property
     def b_rho(self):
@@ -478,8 +956,134 @@ class VarLinear(snt.AbstractModule):
 
     @property
     def b_sigma(self):
+        """
+        Posterior standard deviations, which are 0 for pruned biases
+        """
+        self._ensure_is_connected()
+        return tf.nn.softplus(self._b_rho) * self._b_mask
+
+    @property
+    def b_mask(self):
+        self._ensure_is_connected()
+        return self._b_mask
+
+    def get_posterior_params(self):
+        """
+        The posterior parameters with pruned entries set to 0, as numpy arrays:
+        w_mu, w_sigma, b_mu, b_sigma
+        """
         self._ensure_is_connected()
-        return tf.nn.softplus(self._b_rho)
+
+        return (self.w_mu.numpy(),
+                self.w_sigma.numpy(),
+                self.b_mu.numpy(),
+                self.b_sigma.numpy())
+
+class ScaleMixturePrior(object):
+    """
+    Zero mean scale mixture of two Gaussians from Blundell et al.
+
+        p(w) = pi * N(w | 0, sigma1^2) + (1 - pi) * N(w | 0, sigma2^2)
+
+    The log-density is evaluated as l2(w) + softplus(l1(w) - l2(w)), where
+    l_k(w) = log(pi_k) - log(sigma_k) - log(2 pi) / 2 - w^2 / (2 sigma_k^2), so
+    there are no per-component or stacked temporaries. It exposes the same
+    log_prob / prob interface as a tfp distribution.
+    """
+
+    def __init__(self,
+                 mix_prop,
+                 sigma1,
+                 sigma2,
+                 chunk_size=2**16):
+
+        self.mix_prop = float(mix_prop)
+        self.sigma1 = float(sigma1)
+        self.sigma2 = float(sigma2)
+        self.chunk_size = chunk_size
+
+        # Precompute the constants of the two components.
+        # These are Python floats, so that they get cast to the input's dtype
+        log_norm = 0.5 * np.log(2 * np.pi)
+
+        self._log_coeff_2 = float(np.log(1. - mix_prop) - np.log(sigma2) - log_norm)
+        self._half_prec_2 = float(0.5 / sigma2**2)
+
+        # l1(w) - l2(w) = log_coeff_diff - half_prec_diff * w^2
+        self._log_coeff_diff = float(np.log(mix_prop) - np.log(sigma1) - log_norm) - self._log_coeff_2
+        self._half_prec_diff = float(0.5 / sigma1**2) - self._half_prec_2
+
+    def log_prob(self, x):
+        x_sq = tf.square(x)
+
+        return self._log_coeff_2 - self._half_prec_2 * x_sq + \
+            tf.nn.softplus(self._log_coeff_diff - self._half_prec_diff * x_sq)
+
+    def prob(self, x):
+        return tf.exp(self.log_prob(x))
+
+    def _log_prob_grad(self, x):
+        # d/dx log p(x) = -2x * (half_prec_2 + half_prec_diff * sigmoid(l1 - l2))
+        x_sq = tf.square(x)
+        resp = tf.sigmoid(self._log_coeff_diff - self._half_prec_diff * x_sq)
+
+        return -2. * x * (self._half_prec_2 + self._half_prec_diff * resp)
+
+    def reduce_log_prob(self, x, mask=None):
+        """
+        Sum of log p(x) over all entries of x, or only where the mask is 1 if
+        it is given. The mask can have fewer dimensions than x, e.g. when x
+        is a stack of weight samples.
+
+        It is evaluated on about chunk_size entries at a time, and the
+        gradient is recomputed from x in the backward pass, so the temporaries
+        never exceed the size of a chunk.
+        """
+
+        num_entries = x.shape.num_elements()
+
+        # The number of unpruned entries is only known at run time in a graph
+        # function, so they cannot be split into chunks
+        if num_entries is None:
+            log_prob = self.log_prob(x)
+            return tf.reduce_sum(log_prob if mask is None else mask * log_prob)
+
+        if num_entries == 0:
+            return tf.zeros([], dtype=x.dtype)
+
+        # View x as [rows, cols], where the mask (if any) is broadcast over the rows
+        num_cols = num_entries if mask is None else mask.shape.num_elements()
+        num_rows = num_entries // num_cols
+
+        chunk_cols = max(1, self.chunk_size // num_rows)
+        chunks = [slice(i, i + chunk_cols) for i in range(0, num_cols, chunk_cols)]
+
+        # Read the mask here, so it is a constant of the custom gradient
+        flat_mask = None if mask is None else tf.reshape(mask, [-1])
+
+        def _masked(values, chunk):
+            return values if flat_mask is None else values * flat_mask[chunk]
+
+        @tf.custom_gradient
+        def _reduce_log_prob(x):
+            matrix = tf.reshape(x, [num_rows, num_cols])
+
+            total = tf.add_n([tf.reduce_sum(_masked(self.log_prob(matrix[:, chunk]), chunk))
+                              for chunk in chunks])
+
+            def grad(dy):
+                matrix = tf.reshape(x, [num_rows, num_cols])
+
+                matrix_grad = tf.concat([_masked(self._log_prob_grad(matrix[:, chunk]), chunk)
+                                         for chunk in chunks],
+                                        axis=1)
+
+                return dy * tf.reshape(matrix_grad, tf.shape(x))
+
+            return total, grad
+
+        return _reduce_log_prob(x)
+
 
 # ==============================================================================
 # Auxiliary functions
@@ -490,25 +1094,103 @@ def create_gaussian_prior(params):
     return prior
 
 def create_mixture_prior(params):
-    prior = tfp.distributions.Mixture(
-        cat = tfp.distributions.Categorical(probs=[params["mix_prop"], 1. - params["mix_prop"]]),
-        components=[
-            tfp.distributions.Normal(loc=0., scale=tf.exp(-params["sigma1"])),
-            tfp.distributions.Normal(loc=0., scale=tf.exp(-params["sigma2"])),
-        ])
+    prior = ScaleMixturePrior(mix_prop=params["mix_prop"],
+                              sigma1=np.exp(-params["sigma1"]),
+                              sigma2=np.exp(-params["sigma2"]))
     return prior
 
+def reduce_log_prob(dist, x, mask=None):
+    """
+    Sum of log p(x) over all entries of x (where the mask is 1, if given). Uses
+    the dist's own reduction if it has a more efficient one.
+    """
+    if hasattr(dist, "reduce_log_prob"):
+        return dist.reduce_log_prob(x, mask)
+
+    log_prob = dist.log_prob(x)
+
+    if mask is not None:
+        log_prob = mask * log_prob
+
+    return tf.reduce_sum(log_prob)
+
+def scatter_unmasked(indices, values, shape, sample_shape=()):
+    """
+    Dense tensor of shape sample_shape + shape that is 0 everywhere, except at
+    the flat indices (as returned by tf.where), where it is the values of
+    shape sample_shape + [num_indices]
+    """
+    shape = list(shape)
+    num_entries = int(np.prod(shape))
+
+    if not sample_shape:
+        dense = tf.scatter_nd(indices, values, tf.constant([num_entries], dtype=indices.dtype))
+
+        return tf.reshape(dense, shape)
+
+    # Scatter the samples along the last axis, then move it to the front
+    dense = tf.scatter_nd(indices,
+                          tf.transpose(values),
+                          tf.constant([num_entries] + list(sample_shape), dtype=indices.dtype))
+
+    return tf.reshape(tf.transpose(dense), list(sample_shape) + shape)
+
+def batch_matmul(inputs, w):
+    """
+    x'W for inputs of shape [..., batch_size, input_size] and weights of shape
+    [input_size, output_size] (shared by all leading dimensions) or
+    [num_samples, input_size, output_size] (one matrix per sample)
+    """
+    if inputs.shape.ndims == w.shape.ndims:
+        return tf.matmul(inputs, w)
+
+    return tf.tensordot(inputs, w, axes=1)
+
+def random_sign(shape, dtype=tf.float32):
+    """
+    Samples a tensor of independent, uniformly random +/-1 entries
+    """
+    bits = tf.random_uniform(shape, minval=0, maxval=2, dtype=tf.int32)
+    return 2. * tf.cast(bits, dtype) - 1.
+
+def stack_labels(labels, outputs):
+    """
+    Repeats the labels for every sample if the outputs come from a forward pass
+    with num_samples > 1, i.e. have shape [num_samples, batch_size, ...]
+    """
+    if outputs.shape.ndims < 3:
+        return labels
+
+    num_samples = outputs.shape[0].value
+
+    return tf.tile(tf.expand_dims(labels, 0),
+                   [num_samples] + [1] * labels.shape.ndims)
+
+def average_categorical_logits(logits):
+    """
+    Log of the average predictive probabilities of [num_samples, batch_size, classes]
+    logits, up to an additive constant
+    """
+    if logits.shape.ndims < 3:
+        return logits
+
+    return tf.reduce_logsumexp(tf.nn.log_softmax(logits), axis=0)
+
 def neg_log_prob_with_categorical(logits, labels):
+    # With multiple samples, this is the average over them
+    num_samples = logits.shape[0].value if logits.shape.ndims == 3 else 1
+
     neg_log_prob = tf.nn.sparse_softmax_cross_entropy_with_logits(
-        labels=labels,
+        labels=stack_labels(labels, logits),
         logits=logits)
 
-    return tf.reduce_sum(neg_log_prob)
+    return tf.reduce_sum(neg_log_prob) / num_samples
 
 def neg_log_prob_with_gaussian(predictions, labels, sigma=1.):
+    # The mean squared error is also averaged over the samples
     neg_log_prob = tf.losses.mean_squared_error(
         predictions=tf.reshape(predictions, [-1, 1]),
-        labels=labels)
+        labels=tf.reshape(stack_labels(labels, predictions), [-1, 1]))
 
     neg_log_prob = neg_log_prob / (2 * sigma**2) + tf.math.log(sigma)
 